@@ -0,0 +1,517 @@
+import logging
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+from zeep import Client
+from zeep.transports import Transport
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+LOGGER = logging.getLogger('automationcommon')
+
+
+# The session used for all the checks, so that connections to the services are kept alive between checks,
+# and the pid of the process that created it (sessions aren't shared with forked processes).
+_session = None
+_session_pid = None
+
+# The bound proxies of the SOAP services keyed by (url, name, timeout) with the time they were created. Creating a
+# proxy means fetching and parsing the service's WSDL so they are kept for SERVICE_CHECK_WSDL_TTL seconds (default an
+# hour).
+_soap_proxies = {}
+
+_lock = threading.Lock()
+
+# The cache key of the latest status snapshot (see refresh_status())
+STATUS_CACHE_KEY = 'automationcommon:status'
+
+# The background refresher thread and the pid of the process that started it
+_refresher = None
+_refresher_pid = None
+
+# The thread that checks the default database (with its own persistent connection), the queue of its pending checks
+# and the pid of the process that started it (see check_default_database())
+_database_checker = None
+_database_checker_pid = None
+_database_checks = None
+
+# The default upper bounds (in seconds) of the check latency histogram buckets (see SERVICE_CHECK_BUCKETS)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# The latency histograms and error counts of the checks run by this process keyed by check name (see record_metrics())
+_metrics = {}
+
+
+def get_session():
+    """
+    :return: the process wide requests.Session used for the checks
+    """
+    global _session, _session_pid
+    with _lock:
+        if _session is None or _session_pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=10, pool_maxsize=10)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session, _session_pid = session, os.getpid()
+            _soap_proxies.clear()
+        return _session
+
+
+def get_soap_proxy(service, timeout):
+    """
+    :param service: a SOAP descriptor (a dict with 'url' and 'name')
+    :param timeout: the number of seconds to wait for a response
+    :return: a cached zeep proxy bound to the service
+    """
+    session = get_session()
+    key = (service['url'], service['name'], timeout)
+    with _lock:
+        proxy, created = _soap_proxies.get(key, (None, None))
+    if proxy is None or time.time() - created > getattr(settings, 'SERVICE_CHECK_WSDL_TTL', 3600):
+        client = Client(service['url'], transport=Transport(
+            session=session, timeout=timeout, operation_timeout=timeout
+        ))
+        proxy = client.bind(service_name=service['name'], port_name=service['name'] + 'Soap12')
+        with _lock:
+            _soap_proxies[key] = (proxy, time.time())
+    return proxy
+
+
+def check_service(service, timeout):
+    """
+    Checks that a service listed in SERVICE_CHECKS is working.
+
+    :param service: either the URL of a REST endpoint or a SOAP descriptor (a dict with 'url', 'name' and 'operation')
+    :param timeout: the number of seconds to wait for a response
+    :return: True if the service is working
+    """
+    if isinstance(service, str):
+        # treat as REST endpoint
+        response = get_session().get(service, timeout=timeout)
+        return response.status_code == 200
+    # assume soap descriptor
+    proxy = get_soap_proxy(service, timeout)
+    try:
+        proxy[service['operation']]()
+    except Exception:
+        # the WSDL may have changed
+        with _lock:
+            _soap_proxies.pop((service['url'], service['name'], timeout), None)
+        raise
+    return True
+
+
+def run_checks(checks, timeout=None, deadline=None):
+    """
+    Runs checks concurrently (in a thread each). A check that raises an exception or that hasn't finished within
+    timeout seconds (SERVICE_CHECK_TIMEOUT, default 5) fails. Checks that haven't finished when deadline seconds
+    (SERVICE_CHECK_DEADLINE, default 10) have passed since they were started also fail.
+
+    :param checks: a dict of check callables (that return True if the check passes) keyed by name
+    :param timeout: the number of seconds each check may take
+    :param deadline: the number of seconds all the checks may take
+    :return: a dict of (passed, latency in seconds) tuples keyed by name
+    """
+    if timeout is None:
+        timeout = getattr(settings, 'SERVICE_CHECK_TIMEOUT', 5)
+    if deadline is None:
+        deadline = getattr(settings, 'SERVICE_CHECK_DEADLINE', 10)
+
+    results = {}
+
+    def run(name, check):
+        results[name] = run_check(name, check)
+
+    start = time.time()
+    threads = []
+    for name, check in checks.items():
+        # daemon threads so that a hung check can't stop the process exiting
+        thread = threading.Thread(target=run, args=(name, check), name='status-check-%s' % name)
+        thread.daemon = True
+        thread.start()
+        threads.append((name, thread))
+
+    end = start + min(timeout, deadline)
+    for name, thread in threads:
+        thread.join(max(0, end - time.time()))
+        if name not in results:
+            LOGGER.warning("Status check '%s' timed out" % name)
+            results[name] = (False, time.time() - start)
+
+    # copied as any timed out checks could still set their result
+    return dict(results)
+
+
+def run_check(name, check):
+    """
+    Runs a check on the calling thread.
+
+    :param name: the name of the check
+    :param check: a check callable (that returns True if the check passes)
+    :return: a (passed, latency in seconds) tuple - the check fails if it raises an exception
+    """
+    start = time.time()
+    try:
+        passed = bool(check())
+    except Exception as e:
+        LOGGER.warning("Status check '%s' failed: %s" % (name, e))
+        passed = False
+    return passed, time.time() - start
+
+
+def run_service_checks(timeout=None, deadline=None):
+    """
+    Runs the SERVICE_CHECKS concurrently (see run_checks()).
+
+    :return: a dict of (passed, latency in seconds) tuples keyed by service name
+    """
+    if timeout is None:
+        timeout = getattr(settings, 'SERVICE_CHECK_TIMEOUT', 5)
+    return run_checks(service_checks(timeout), timeout=timeout, deadline=deadline)
+
+
+def service_checks(timeout):
+    """
+    :param timeout: the number of seconds to wait for each service's response
+    :return: a dict of checks of the SERVICE_CHECKS keyed by service name
+    """
+    return dict(
+        (name, lambda service=service: check_service(service, timeout))
+        for name, service in getattr(settings, 'SERVICE_CHECKS', {}).items()
+    )
+
+
+def check_database(alias=DEFAULT_DB_ALIAS, close=False):
+    """
+    Checks that a database is working with a bare SELECT 1 (rather than an ORM query).
+
+    :param alias: the alias of the database in DATABASES
+    :param close: whether to close the connection afterwards (as it won't be reused by a check's thread)
+    :return: True if the database is working
+    """
+    connection = connections[alias]
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1' + connection.features.bare_select_suffix)
+            return cursor.fetchone()[0] == 1
+    finally:
+        if close:
+            connection.close()
+
+
+def database_check_name(alias):
+    """
+    :param alias: the alias of a database in DATABASES
+    :return: the name of the check of the database - 'Database' for the default database
+    """
+    return 'Database' if alias == DEFAULT_DB_ALIAS else 'Database (%s)' % alias
+
+
+def status_database_aliases():
+    """
+    :return: the aliases of the databases that are checked - STATUS_DATABASES (default all of DATABASES)
+    """
+    return getattr(settings, 'STATUS_DATABASES', None) or list(settings.DATABASES)
+
+
+def check_default_database():
+    """
+    Checks the default database on a long lived daemon thread so that the check can be timed out (see run_checks())
+    while still reusing a persistent connection. If the database is hung then a check that would have to queue behind
+    more than one unfinished check fails straight away.
+
+    :return: True if the database is working
+    """
+    global _database_checker, _database_checker_pid, _database_checks
+    with _lock:
+        if _database_checker is None or _database_checker_pid != os.getpid() or not _database_checker.is_alive():
+            _database_checks = queue.Queue(maxsize=1)
+            _database_checker = threading.Thread(
+                target=_check_database_forever, args=(_database_checks,), name='status-database'
+            )
+            _database_checker.daemon = True
+            _database_checker.start()
+            _database_checker_pid = os.getpid()
+        checks = _database_checks
+    result = []
+    done = threading.Event()
+    try:
+        checks.put_nowait((result, done))
+    except queue.Full:
+        raise RuntimeError("the previous checks of the default database haven't finished")
+    done.wait()
+    if isinstance(result[0], Exception):
+        raise result[0]
+    return result[0]
+
+
+def _check_database_forever(checks):
+    """
+    Runs the queued checks of the default database (see check_default_database()).
+
+    :param checks: the queue of (result list, done event) tuples
+    """
+    while True:
+        result, done = checks.get()
+        try:
+            # what the request signals would otherwise do for a persistent connection
+            connections[DEFAULT_DB_ALIAS].close_if_unusable_or_obsolete()
+            result.append(check_database())
+        except Exception as e:
+            result.append(e)
+        done.set()
+
+
+def database_checks():
+    """
+    The checks of the databases in STATUS_DATABASES. The default database is checked with its own persistent
+    connection (see check_default_database()) but the other databases' checks are run in their own threads so each
+    opens (and then closes) a new connection to its database.
+
+    :return: a dict of checks of the databases in STATUS_DATABASES keyed by check name
+    """
+    return dict(
+        (database_check_name(alias), check_default_database if alias == DEFAULT_DB_ALIAS else
+         lambda alias=alias: check_database(alias, close=True))
+        for alias in status_database_aliases()
+    )
+
+
+def run_all_checks():
+    """
+    Runs the database checks and the SERVICE_CHECKS concurrently (see run_checks()).
+
+    :return: a dict of (passed, latency in seconds) tuples keyed by check name
+    """
+    timeout = getattr(settings, 'SERVICE_CHECK_TIMEOUT', 5)
+    checks = database_checks()
+    checks.update(service_checks(timeout))
+    results = run_checks(checks, timeout=timeout)
+    record_metrics(results)
+    return results
+
+
+def record_metrics(results):
+    """
+    Adds the latencies of a set of check results to the latency histograms (with buckets of SERVICE_CHECK_BUCKETS
+    seconds) and counts the failures.
+
+    :param results: a dict of (passed, latency in seconds) tuples keyed by check name
+    """
+    buckets = tuple(getattr(settings, 'SERVICE_CHECK_BUCKETS', DEFAULT_BUCKETS))
+    with _lock:
+        for name, (passed, latency) in results.items():
+            metric = _metrics.get(name)
+            if metric is None or metric['buckets'] != buckets:
+                metric = _metrics[name] = {
+                    'buckets': buckets, 'counts': [0] * len(buckets), 'count': 0, 'sum': 0.0, 'errors': 0
+                }
+            # the counts are cumulative (as Prometheus expects)
+            for i, bound in enumerate(buckets):
+                if latency <= bound:
+                    metric['counts'][i] += 1
+            metric['count'] += 1
+            metric['sum'] += latency
+            if not passed:
+                metric['errors'] += 1
+
+
+def get_metrics():
+    """
+    :return: a copy of the latency histograms and error counts of the checks run by this process - a dict of dicts
+             (with 'buckets', cumulative 'counts', 'count', 'sum' and 'errors') keyed by check name
+    """
+    with _lock:
+        return dict((name, dict(metric, counts=list(metric['counts']))) for name, metric in _metrics.items())
+
+
+def status_as_dict(results, age=None):
+    """
+    :param results: a dict of (passed, latency in seconds) tuples keyed by check name
+    :param age: the age of the status snapshot in seconds (if any)
+    :return: the results and metrics as a JSON serialisable dict
+    """
+    metrics = get_metrics()
+    checks = {}
+    for name, (passed, latency) in results.items():
+        check = {'up': passed, 'latency': latency}
+        metric = metrics.get(name)
+        if metric is not None:
+            check.update({
+                'errors': metric['errors'],
+                'histogram': {
+                    'buckets': list(zip(metric['buckets'], metric['counts'])),
+                    'count': metric['count'], 'sum': metric['sum'],
+                },
+            })
+        checks[name] = check
+    status = {
+        'up': all(passed for passed, latency in results.values()),
+        'checks': checks,
+        'snapshot_age': age,
+    }
+    status['database_ping'] = dict(
+        (alias, results[name][1]) for alias, name in _database_check_names(results)
+    )
+    return status
+
+
+def _database_check_names(results):
+    """
+    :return: the sorted (alias, check name) pairs of the databases that have results
+    """
+    return sorted(
+        (alias, database_check_name(alias)) for alias in settings.DATABASES if database_check_name(alias) in results
+    )
+
+
+def _escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def status_as_prometheus(results, age=None):
+    """
+    :param results: a dict of (passed, latency in seconds) tuples keyed by check name
+    :param age: the age of the status snapshot in seconds (if any)
+    :return: the results and metrics in the Prometheus text exposition format
+    """
+    metrics = get_metrics()
+    names = sorted(results)
+    lines = [
+        '# HELP automationcommon_check_up Whether the check passed (1) or not (0).',
+        '# TYPE automationcommon_check_up gauge',
+    ]
+    lines += [
+        'automationcommon_check_up{check="%s"} %d' % (_escape_label(name), results[name][0]) for name in names
+    ]
+    lines += [
+        '# HELP automationcommon_check_latency_seconds The latency of the last check.',
+        '# TYPE automationcommon_check_latency_seconds gauge',
+    ]
+    lines += [
+        'automationcommon_check_latency_seconds{check="%s"} %r' % (_escape_label(name), float(results[name][1]))
+        for name in names
+    ]
+    lines += [
+        '# HELP automationcommon_check_duration_seconds The latencies of the checks run by this process.',
+        '# TYPE automationcommon_check_duration_seconds histogram',
+    ]
+    for name in sorted(metrics):
+        metric, label = metrics[name], _escape_label(name)
+        for bound, count in zip(metric['buckets'], metric['counts']):
+            lines.append('automationcommon_check_duration_seconds_bucket{check="%s",le="%r"} %d' % (
+                label, float(bound), count
+            ))
+        lines += [
+            'automationcommon_check_duration_seconds_bucket{check="%s",le="+Inf"} %d' % (label, metric['count']),
+            'automationcommon_check_duration_seconds_sum{check="%s"} %r' % (label, metric['sum']),
+            'automationcommon_check_duration_seconds_count{check="%s"} %d' % (label, metric['count']),
+        ]
+    lines += [
+        '# HELP automationcommon_check_errors_total The number of failed checks run by this process.',
+        '# TYPE automationcommon_check_errors_total counter',
+    ]
+    lines += [
+        'automationcommon_check_errors_total{check="%s"} %d' % (_escape_label(name), metrics[name]['errors'])
+        for name in sorted(metrics)
+    ]
+    databases = _database_check_names(results)
+    if databases:
+        lines += [
+            '# HELP automationcommon_database_ping_seconds The latency of the last database check.',
+            '# TYPE automationcommon_database_ping_seconds gauge',
+        ]
+        lines += [
+            'automationcommon_database_ping_seconds{alias="%s"} %r' % (_escape_label(alias), float(results[name][1]))
+            for alias, name in databases
+        ]
+    if age is not None:
+        lines += [
+            '# HELP automationcommon_status_snapshot_age_seconds The age of the status snapshot.',
+            '# TYPE automationcommon_status_snapshot_age_seconds gauge',
+            'automationcommon_status_snapshot_age_seconds %r' % float(age),
+        ]
+    return '\n'.join(lines) + '\n'
+
+
+def refresh_status():
+    """
+    Runs all the checks and stores the results in the cache as the latest status snapshot.
+
+    :return: the snapshot - a dict with the 'results' of run_all_checks() and the 'timestamp' they were taken
+    """
+    snapshot = {'results': run_all_checks(), 'timestamp': time.time()}
+    cache.set(STATUS_CACHE_KEY, snapshot, None)
+    return snapshot
+
+
+def _refresh_forever(interval):
+    """
+    The body of the background refresher thread.
+    """
+    while True:
+        # if the cache is shared then only one process needs to refresh the snapshot each interval
+        if cache.add(STATUS_CACHE_KEY + ':lock', os.getpid(), interval):
+            try:
+                refresh_status()
+            except Exception as e:
+                LOGGER.error("Failed to refresh the status snapshot: %s" % e)
+            finally:
+                connections.close_all()
+        time.sleep(interval)
+
+
+def start_refresher(interval):
+    """
+    Starts (if it isn't already running in this process) a daemon thread that refreshes the status snapshot every
+    interval seconds.
+
+    :param interval: the number of seconds between refreshes
+    """
+    global _refresher, _refresher_pid
+    with _lock:
+        if _refresher is None or _refresher_pid != os.getpid() or not _refresher.is_alive():
+            _refresher = threading.Thread(target=_refresh_forever, args=(interval,), name='status-refresher')
+            _refresher.daemon = True
+            _refresher.start()
+            _refresher_pid = os.getpid()
+
+
+def get_status():
+    """
+    Gets the results of all the checks. If SERVICE_CHECK_INTERVAL is set then the checks aren't run - instead the
+    latest status snapshot is returned. The snapshot is refreshed every SERVICE_CHECK_INTERVAL seconds by a background
+    thread or, if SERVICE_CHECK_REFRESHER is 'celery', by a periodic automationcommon.utils.refresh_status_snapshot
+    task. If there is no snapshot yet then it is refreshed straight away. If the snapshot is older than
+    SERVICE_CHECK_MAX_AGE seconds (default 3 intervals) then a failed 'Status snapshot' result is added.
+
+    :return: a (results, age) tuple where results is a dict of (passed, latency in seconds) tuples keyed by check
+             name and age is the age of the snapshot in seconds (or None if the checks were run)
+    """
+    interval = getattr(settings, 'SERVICE_CHECK_INTERVAL', None)
+    if not interval:
+        return run_all_checks(), None
+
+    if getattr(settings, 'SERVICE_CHECK_REFRESHER', 'thread') == 'thread':
+        start_refresher(interval)
+
+    snapshot = cache.get(STATUS_CACHE_KEY)
+    if snapshot is None:
+        snapshot = refresh_status()
+
+    results = dict(snapshot['results'])
+    age = time.time() - snapshot['timestamp']
+    if age > getattr(settings, 'SERVICE_CHECK_MAX_AGE', 3 * interval):
+        LOGGER.warning("The status snapshot is %d seconds old" % age)
+        results['Status snapshot'] = (False, 0)
+    return results, age
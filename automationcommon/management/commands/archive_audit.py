@@ -0,0 +1,154 @@
+import datetime
+import gzip
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from automationcommon.models import Audit
+from automationcommon.utils import iter_json_lines
+
+# the Audit fields that are archived
+ARCHIVE_FIELDS = ('id', 'when', 'who', 'model', 'model_pk', 'field', 'old', 'new')
+
+
+class Command(BaseCommand):
+    """
+    Archives audit records older than the retention period (AUDIT_RETENTION_DAYS, default 365) to a gzipped JSON Lines
+    file and then deletes them. Optionally the remaining records older than --compact-days are compacted by collapsing
+    consecutive changes to the same field of the same object by the same user into one record.
+    """
+    help = 'Archives (and deletes) old audit records and optionally compacts the remaining ones.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=getattr(settings, 'AUDIT_RETENTION_DAYS', 365),
+            help='archive records older than this many days'
+        )
+        parser.add_argument(
+            '--output-dir', default='.', help='the directory to write the archive file to'
+        )
+        parser.add_argument(
+            '--chunk-size', type=int, default=1000,
+            help='the number of records selected (and deleted) per query'
+        )
+        parser.add_argument(
+            '--compact-days', type=int, default=None,
+            help='compact the remaining records older than this many days'
+        )
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        chunk_size = options['chunk_size']
+
+        cutoff = now - datetime.timedelta(days=options['days'])
+        path = os.path.join(options['output_dir'], 'audit-%s.jsonl.gz' % cutoff.strftime('%Y%m%dT%H%M%S'))
+        archived = self.archive(cutoff, path, chunk_size)
+        if archived:
+            self.stdout.write('Archived %d audit records to %s' % (archived, path))
+        else:
+            self.stdout.write('No audit records to archive')
+
+        if options['compact_days'] is not None:
+            compact_cutoff = now - datetime.timedelta(days=options['compact_days'])
+            compacted = self.compact(compact_cutoff, chunk_size)
+            self.stdout.write('Compacted %d audit records' % compacted)
+
+    @staticmethod
+    def archive(cutoff, path, chunk_size):
+        """
+        Streams the records older than cutoff to a file in chunks and then deletes them in chunks (so that the table
+        isn't locked for long).
+
+        :param cutoff: the time before which records are archived
+        :param path: the path of the archive file
+        :param chunk_size: the number of records selected (and deleted) per query
+        :return: the number of records archived
+        """
+        queryset = Audit.objects.filter(when__lt=cutoff).order_by('id')
+
+        archived = 0
+        last_id = None
+        tmp_path = path + '.tmp'
+        with gzip.open(tmp_path, 'wb') as archive:
+            while True:
+                chunk = queryset if last_id is None else queryset.filter(id__gt=last_id)
+                rows = list(chunk.values(*ARCHIVE_FIELDS)[:chunk_size])
+                if not rows:
+                    break
+                for lines in iter_json_lines(rows):
+                    archive.write(lines.encode('utf-8'))
+                archived += len(rows)
+                last_id = rows[-1]['id']
+
+        if not archived:
+            os.remove(tmp_path)
+            return 0
+        # only delete the records once the archive is complete
+        os.rename(tmp_path, path)
+
+        while True:
+            ids = list(queryset.filter(id__lte=last_id).values_list('id', flat=True)[:chunk_size])
+            if not ids:
+                break
+            Audit.objects.filter(id__in=ids).delete()
+
+        return archived
+
+    @staticmethod
+    def compact(cutoff, chunk_size):
+        """
+        Collapses each run of consecutive changes to the same field of the same object by the same user (older than
+        cutoff) into the last record of the run with the first record's original value. The records are streamed and
+        the runs are written as they are found, with each group of runs (of about chunk_size records) updated and
+        deleted together in one transaction.
+
+        :param cutoff: the time before which records are compacted
+        :param chunk_size: the number of records deleted per transaction
+        :return: the number of records removed
+        """
+        rows = Audit.objects.filter(when__lt=cutoff).order_by('model', 'model_pk', 'field', 'when', 'id').values_list(
+            'id', 'model', 'model_pk', 'field', 'who', 'old'
+        )
+
+        # the (ids, original value) of the runs found but not yet written and the number of records they will remove
+        runs = []
+        pending = 0
+        removed = 0
+        run_key = run_old = run_ids = None
+        for row in rows.iterator():
+            key = row[1:5]
+            if key != run_key:
+                if run_ids and len(run_ids) > 1:
+                    runs.append((run_ids, run_old))
+                    pending += len(run_ids) - 1
+                    if pending >= chunk_size:
+                        removed += Command.collapse_runs(runs, chunk_size)
+                        runs, pending = [], 0
+                run_key, run_old, run_ids = key, row[5], []
+            run_ids.append(row[0])
+        if run_ids and len(run_ids) > 1:
+            runs.append((run_ids, run_old))
+        if runs:
+            removed += Command.collapse_runs(runs, chunk_size)
+
+        return removed
+
+    @staticmethod
+    def collapse_runs(runs, chunk_size):
+        """
+        Collapses runs of records in one transaction (so that a run is never left half collapsed).
+
+        :param runs: a list of (ids, original value) tuples - one for each run
+        :param chunk_size: the number of records deleted per query
+        :return: the number of records removed
+        """
+        deletes = [pk for ids, old in runs for pk in ids[:-1]]
+        with transaction.atomic():
+            for ids, old in runs:
+                Audit.objects.filter(id=ids[-1]).update(old=old)
+            for start in range(0, len(deletes), chunk_size):
+                Audit.objects.filter(id__in=deletes[start:start + chunk_size]).delete()
+        return len(deletes)
@@ -1,9 +1,14 @@
-from automationcommon.models import clear_local_user, set_local_user
+from django.conf import settings
+
+from automationcommon.models import (
+    clear_local_user, set_local_user, start_audit_batch, flush_audit_batch, discard_audit_batch
+)
 
 
 class RequestUserMiddleware(object):
     """
-    Middleware that simply set's the request.user to be used for the audit trail.
+    Middleware that simply set's the request.user to be used for the audit trail. If AUDIT_BATCH_REQUESTS is set then
+    all the audit records created by a request are also buffered and written with a single INSERT when it completes.
     """
     def __init__(self, get_response=None):
         self.get_response = get_response
@@ -19,18 +24,22 @@ class RequestUserMiddleware(object):
     @classmethod
     def process_request(cls, request):
         set_local_user(request.user)
+        if getattr(settings, 'AUDIT_BATCH_REQUESTS', False):
+            start_audit_batch()
 
     @classmethod
     def process_response(cls, request, response):
         """
-        Clear the user to minimise the chance of a user being wrongly assigned.
+        Clear the user to minimise the chance of a user being wrongly assigned and write any buffered audit records.
         """
         clear_local_user()
+        flush_audit_batch()
         return response
 
     @classmethod
     def process_exception(cls, request, exception):
         """
-        Clear the user to minimise the chance of a user being wrongly assigned.
+        Clear the user to minimise the chance of a user being wrongly assigned and drop any buffered audit records.
         """
         clear_local_user()
+        discard_audit_batch()
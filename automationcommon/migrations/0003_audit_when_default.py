@@ -0,0 +1,19 @@
+# Generated by Django 2.1.15 on 2026-10-18 01:16
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('automationcommon', '0002_auto_20180227_1535'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='audit',
+            name='when',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 2.1.15 on 2026-10-18 01:16
+
+from django.conf import settings
+from django.db import migrations
+
+
+BRIN_INDEX_NAME = 'automationcommon_audit_when_brin'
+
+
+def create_brin_index(apps, schema_editor):
+    """
+    On PostgreSQL, if AUDIT_BRIN_INDEX is set, adds a (very small) BRIN index on Audit.when for time range queries
+    over large audit tables.
+    """
+    if schema_editor.connection.vendor == 'postgresql' and getattr(settings, 'AUDIT_BRIN_INDEX', False):
+        schema_editor.execute('CREATE INDEX IF NOT EXISTS %s ON %s USING brin (%s)' % (
+            schema_editor.quote_name(BRIN_INDEX_NAME),
+            schema_editor.quote_name(apps.get_model('automationcommon', 'Audit')._meta.db_table),
+            schema_editor.quote_name('when'),
+        ))
+
+
+def drop_brin_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS %s' % schema_editor.quote_name(BRIN_INDEX_NAME))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('automationcommon', '0003_audit_when_default'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='audit',
+            index_together={('who', 'when'), ('model', 'model_pk', 'when')},
+        ),
+        migrations.RunPython(create_brin_index, drop_brin_index),
+    ]
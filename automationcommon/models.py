@@ -1,16 +1,26 @@
 import logging
 import threading
+from contextlib import contextmanager
+from operator import attrgetter, itemgetter
+
 import django
 from distutils.version import StrictVersion
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser
-from django.db import models
-from django.forms import model_to_dict
+from django.db import models, transaction
+from django.db.models import Case, Value, When
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
 
 LOGGER = logging.getLogger('automationcommon')
 
+# The marker from_db() uses for deferred fields (added in Django 1.10)
+DEFERRED = getattr(models, 'DEFERRED', object())
+
 
 LOCAL_USER_WARNING = """
     Use automationcommon.models.set_local_user() to set the user to be used in the audit trail or
@@ -34,6 +44,41 @@ class Creatable(models.Model):
         abstract = True
 
 
+class AuditQuerySet(models.QuerySet):
+    """
+    A QuerySet of Audit records with helpers for looking up change histories. Histories are ordered newest first
+    and should be paged by passing the last record of a page to before() (rather than with OFFSET), e.g.::
+
+        page = Audit.objects.history_for(instance)[:25]
+        next_page = Audit.objects.history_for(instance).before(page[24])[:25]
+    """
+
+    def history_for(self, instance):
+        """
+        :param instance: a model instance (that uses ModelChangeMixin)
+        :return: the instance's audit records, newest first
+        """
+        return self.filter(model=instance.__class__.__name__, model_pk=repr(instance.pk)).order_by('-when', '-id')
+
+    def history_for_model(self, model, since=None):
+        """
+        :param model: a model class (that uses ModelChangeMixin)
+        :param since: if given, only return the records of changes made at or after this time
+        :return: the audit records of all of the model's instances, newest first
+        """
+        queryset = self.filter(model=model.__name__)
+        if since is not None:
+            queryset = queryset.filter(when__gte=since)
+        return queryset.order_by('-when', '-id')
+
+    def before(self, audit):
+        """
+        :param audit: an Audit record
+        :return: the records that come after the given record in a history (i.e. the older ones)
+        """
+        return self.filter(models.Q(when__lt=audit.when) | models.Q(when=audit.when, id__lt=audit.id))
+
+
 class Audit(models.Model):
     """
     A model that defines an audit record for a change to any django model
@@ -47,7 +92,8 @@ class Audit(models.Model):
         old       the changed field's original value
         new       the changed field's updated value
     """
-    when = models.DateTimeField(auto_now=True)
+    # a default (rather than auto_now) so that the time of the change is kept when the record is written later
+    when = models.DateTimeField(default=timezone.now, editable=False)
 
     who = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete="CASCADE") \
         if StrictVersion(django.get_version()) >= StrictVersion('2.0') else \
@@ -63,9 +109,39 @@ class Audit(models.Model):
 
     new = models.CharField(max_length=255, null=True, blank=True)
 
+    objects = AuditQuerySet.as_manager()
+
+    class Meta:
+        # for looking up the history of an object and the changes made by a user
+        index_together = [
+            ('model', 'model_pk', 'when'),
+            ('who', 'when'),
+        ]
+
+    def to_record(self):
+        """
+        :return: a compact JSON serialisable representation of the (unsaved) audit record for queueing
+        """
+        return [
+            self.when.isoformat(), self.who_id, self.model, self.model_pk,
+            self.field, self._meta.get_field('old').to_python(self.old), self._meta.get_field('new').to_python(self.new)
+        ]
+
+    @classmethod
+    def from_record(cls, record):
+        """
+        :param record: a representation of an audit record returned by to_record()
+        :return: an unsaved Audit
+        """
+        when, who_id, model, model_pk, field, old, new = record
+        return cls(
+            when=parse_datetime(when), who_id=who_id, model=model, model_pk=model_pk, field=field, old=old, new=new
+        )
+
 
 # A thread local object used for binding the user currently updating the model to the thread.
-# The user's id is stored instead of the object to avoid issues with stale user objects.
+# The user's id is stored along with a cached copy of the user object. The cached copy is dropped whenever the user is
+# saved or deleted (see _invalidate_local_user()) and then reloaded by id, to avoid issues with stale user objects.
 # An id of -1 is used to store an anonymous user.
 _thread_local = threading.local()
 
@@ -79,6 +155,7 @@ def set_local_user(user):
     # workaround for is_anonymous being an attribute in Django >=1.10
     is_anon = user.is_anonymous() if callable(user.is_anonymous) else user.is_anonymous
     _thread_local.user_id = -1 if is_anon else user.id
+    _thread_local.user = None if is_anon else user
 
 
 def get_local_user():
@@ -91,8 +168,13 @@ def get_local_user():
         return None
     elif user_id == -1:
         return AnonymousUser()
-    else:
-        return get_user_model().objects.filter(id=user_id).first()
+
+    user = getattr(_thread_local, 'user', None)
+    if user is None:
+        # the user is only loaded once per request (or after it has changed)
+        user = get_user_model().objects.filter(id=user_id).first()
+        _thread_local.user = user
+    return user
 
 
 def clear_local_user():
@@ -100,25 +182,239 @@ def clear_local_user():
     Clear's the user from the current thread
     """
     _thread_local.user_id = None
+    _thread_local.user = None
+
+
+@receiver(post_save, dispatch_uid='automationcommon_invalidate_local_user_save')
+@receiver(post_delete, dispatch_uid='automationcommon_invalidate_local_user_delete')
+def _invalidate_local_user(sender, instance, **kwargs):
+    """
+    Drops the current thread's cached user if it has been saved or deleted.
+    """
+    user = getattr(_thread_local, 'user', None)
+    if user is not None and sender is user.__class__ and instance.pk == _thread_local.user_id:
+        _thread_local.user = None
+
+
+def start_audit_batch():
+    """
+    Starts buffering Audit records on the current thread so that they can be written with a single INSERT by
+    flush_audit_batch(). Has no effect if a batch has already been started.
+    """
+    if getattr(_thread_local, 'audit_batch', None) is None:
+        _thread_local.audit_batch = []
+
+
+def flush_audit_batch():
+    """
+    Stops buffering Audit records on the current thread and writes any buffered records. If a transaction is open
+    the write is deferred until it commits (and dropped if it is rolled back).
+    """
+    batch = getattr(_thread_local, 'audit_batch', None)
+    _thread_local.audit_batch = None
+    if batch is not None:
+        # Registered even if the batch is empty as records made inside the transaction are only added to it when it
+        # commits (by callbacks registered before this one - see write_audits()).
+        # transaction.on_commit() was added in Django 1.9
+        on_commit = getattr(transaction, 'on_commit', lambda func: func())
+        on_commit(lambda: batch and _persist_audits(batch))
+
+
+def discard_audit_batch():
+    """
+    Stops buffering Audit records on the current thread, dropping any buffered records.
+    """
+    _thread_local.audit_batch = None
+
+
+@contextmanager
+def audit_batch():
+    """
+    A context manager that buffers all the Audit records created within it and writes them with a single INSERT
+    when it exits (see start_audit_batch()). The records are dropped if an exception is raised. Nested uses join the
+    outermost batch.
+    """
+    if getattr(_thread_local, 'audit_batch', None) is not None:
+        yield
+        return
+    start_audit_batch()
+    try:
+        yield
+    except BaseException:
+        discard_audit_batch()
+        raise
+    flush_audit_batch()
+
+
+def write_audits(audits):
+    """
+    Writes a list of unsaved Audit records, either to the current thread's batch (if one has been started) or
+    directly with a single INSERT. Records made inside a transaction are only added to the batch when it commits.
+
+    :param audits: list of Audit instances
+    """
+    if not audits:
+        return
+    batch = getattr(_thread_local, 'audit_batch', None)
+    if batch is not None:
+        if transaction.get_connection().in_atomic_block and hasattr(transaction, 'on_commit'):
+            # only buffer the records once the change is committed (they're dropped if it's rolled back)
+            transaction.on_commit(lambda: batch.extend(audits))
+        else:
+            batch.extend(audits)
+    elif getattr(settings, 'AUDIT_ASYNC', False):
+        # don't queue the records of changes that might be rolled back
+        on_commit = getattr(transaction, 'on_commit', lambda func: func())
+        on_commit(lambda: _persist_audits(audits))
+    else:
+        _persist_audits(audits)
+
+
+def _persist_audits(audits):
+    """
+    Writes a list of unsaved Audit records with a single INSERT or, if AUDIT_ASYNC is set, queues them to be written
+    by a celery worker (see automationcommon.utils.write_audit_records()). If the records can't be queued they are
+    written straight away.
+
+    :param audits: list of Audit instances
+    """
+    if getattr(settings, 'AUDIT_ASYNC', False):
+        # imported here as automationcommon.utils imports this module
+        from automationcommon.utils import write_audit_records
+        try:
+            write_audit_records.delay([audit.to_record() for audit in audits])
+            return
+        except Exception as e:
+            LOGGER.warning("Couldn't queue %d audit records (%s) - writing them now" % (len(audits), e))
+    Audit.objects.bulk_create(audits)
 
 
 class ModelChangeMixin(object):
     """
     A model mixin that tracks changes to model fields' values and saves an Audit record per changed field
-    when the model is saved. Based ModelDiffMixin on here:
+    when the model is saved. All the records for a save are written with a single INSERT (see write_audits()).
+    Based ModelDiffMixin on here:
     https://stackoverflow.com/questions/1355150/django-when-saving-how-can-you-check-if-a-field-has-changed
     """
+    # If True then the initial state of instances loaded from the database isn't captured until it is needed (by
+    # diffs, save() or delete()). Instead the row that from_db() passes to __init__() is kept, which makes loading
+    # read-only instances (e.g. for a list view) cheaper.
+    audit_lazy = False
+
     def __init__(self, *args, **kwargs):
         super(ModelChangeMixin, self).__init__(*args, **kwargs)
-        self.__initial = self._dict
+        self.__row = None
+        self.__deferred = False
+        if args and not kwargs:
+            row_getter, row_length = self._audit_plan()[2:]
+            if row_getter is not None and len(args) == row_length:
+                # Fields deferred by the queryset (Django >=1.10) are captured as DEFERRED rather than being loaded.
+                # Their initial values are only loaded if they are assigned (see _load_deferred_initial()).
+                self.__deferred = DEFERRED in args
+                if self.audit_lazy:
+                    self.__row = args
+                    self.__initial = None
+                else:
+                    self.__initial = row_getter(args)
+                return
+        self.__initial = self._snapshot()
+
+    @classmethod
+    def _audit_plan(cls):
+        """
+        The plan is worked out the first time it is needed and then cached on the model class (rather than in
+        __init_subclass__, which isn't available in python 2).
+
+        :return: a (fields, getter, row_getter, row_length) tuple where fields is a tuple of the model's audited fields
+                 (the same fields model_to_dict() would use), getter returns a tuple of their current values given an
+                 instance and row_getter returns the same given a full row of the model's concrete field values
+                 (or is None if the values can't be taken from the row)
+        """
+        plan = cls.__dict__.get('_audit_plan_cache')
+        if plan is None:
+            # NOTE: an internal attribute has been used when introspecting the model.
+            fields = tuple(field for field in cls._meta.fields if getattr(field, 'editable', False))
+            concrete_fields = list(cls._meta.concrete_fields)
+            row_getter = None
+            if len(fields) > 1 and all(
+                type(field).value_from_object == models.Field.value_from_object for field in fields
+            ):
+                # read the attributes directly (attrgetter() only returns a tuple for more than one attribute)
+                getter = attrgetter(*[field.attname for field in fields])
+                if all(field in concrete_fields for field in fields):
+                    row_getter = itemgetter(*[concrete_fields.index(field) for field in fields])
+            else:
+                def getter(obj):
+                    return tuple(field.value_from_object(obj) for field in fields)
+            plan = (fields, getter, row_getter, len(concrete_fields))
+            cls._audit_plan_cache = plan
+        return plan
+
+    def _snapshot(self):
+        """
+        :return: a tuple of the current values of the model's audited fields (ordered as per _audit_plan()) -
+                 any fields that are still deferred are returned as DEFERRED
+        """
+        if self.__deferred:
+            return tuple(
+                field.value_from_object(self) if field.attname in self.__dict__ else DEFERRED
+                for field in self._audit_plan()[0]
+            )
+        return self._audit_plan()[1](self)
+
+    def _initial_snapshot(self):
+        """
+        :return: a tuple of the initial values of the model's audited fields (ordered as per _audit_plan())
+        """
+        if self.__initial is None:
+            self.__initial = self._audit_plan()[2](self.__row)
+            self.__row = None
+        return self.__initial
+
+    def _load_deferred_initial(self, all_fields=False):
+        """
+        Loads the initial values of deferred fields from the database (with a single query) so that changes to them
+        can be audited.
+
+        :param all_fields: if True then all the deferred fields are loaded - otherwise only those that have been
+                           assigned since the instance was loaded
+        """
+        if not self.__deferred or self.pk is None:
+            return
+        fields = self._audit_plan()[0]
+        initial = list(self._initial_snapshot())
+        missing = [
+            i for i, (field, old) in enumerate(zip(fields, initial))
+            if old is DEFERRED and (all_fields or field.attname in self.__dict__)
+        ]
+        if not missing:
+            return
+        values = self.__class__._base_manager.using(self._state.db).filter(pk=self.pk).values_list(
+            *[fields[i].attname for i in missing]
+        ).first()
+        if values is not None:
+            for i, value in zip(missing, values):
+                initial[i] = value
+            self.__initial = tuple(initial)
+
+    def _reset_initial_snapshot(self, fields):
+        """
+        Resets the initial values of some of the model's audited fields to their current values.
+
+        :param fields: the fields to reset
+        """
+        fields = set(fields)
+        self.__initial = tuple(
+            new if field in fields else old
+            for field, old, new in zip(self._audit_plan()[0], self._initial_snapshot(), self._snapshot())
+        )
 
     @property
     def _dict(self):
         """
         :return: a dict of the model's fields and their current values
         """
-        # NOTE: an internal attribute has been used when introspecting the model.
-        return model_to_dict(self, fields=[field.name for field in self._meta.fields])
+        return dict(zip([field.name for field in self._audit_plan()[0]], self._snapshot()))
 
     def audit_compare(self, field, old, new):
         """
@@ -137,11 +433,11 @@ class ModelChangeMixin(object):
         """
         :return: An array of any changed fields. Each item is a sequence: (field_name, (original_value, updated_value))
         """
-        d1 = self.__initial
-        d2 = self._dict
+        self._load_deferred_initial()
         return [
-            (k, (v, d2[k])) for k, v in d1.items()
-            if self.audit_compare(self._meta.get_field(k), v, d2[k])
+            (field.name, (old, new))
+            for field, old, new in zip(self._audit_plan()[0], self._initial_snapshot(), self._snapshot())
+            if old is not DEFERRED and self.audit_compare(field, old, new)
         ]
 
     def save(self, *args, **kwargs):
@@ -149,28 +445,33 @@ class ModelChangeMixin(object):
         Saves model, created an Audit record per changed field, and resets the initial state.
         """
         creating = self._state.adding
+        if not creating:
+            # the original values of any assigned deferred fields are needed before they're overwritten
+            self._load_deferred_initial()
         super(ModelChangeMixin, self).save(*args, **kwargs)
         # Don't audit new records
         if not creating:
             request_user = get_local_user()
+            audits = []
             for diff in self.diffs:
                 if request_user:
                     # Workaround for is_anonymous becoming an attribute in Django >=1.10.
                     is_anon = request_user.is_anonymous() if callable(request_user.is_anonymous) else request_user.is_anonymous
-                    Audit.objects.create(
+                    audits.append(Audit(
                         who=None if is_anon else request_user,
                         model=self.__class__.__name__,
                         model_pk=repr(self.pk),
                         field=diff[0],
                         old=diff[1][0], new=diff[1][1]
-                    )
+                    ))
                 else:
                     LOGGER.warning("Don't know who made this change: (model=%s:%s, field=%s, old='%s', new='%s')" % (
                         self.__class__.__name__, self.pk, diff[0], diff[1][0], diff[1][1]
                     ))
                     LOGGER.warning(LOCAL_USER_WARNING)
+            write_audits(audits)
 
-        self.__initial = self._dict
+        self.__initial = self._snapshot()
 
     def delete(self, *args, **kwargs):
         """
@@ -178,17 +479,171 @@ class ModelChangeMixin(object):
         """
         request_user = get_local_user()
         if request_user:
+            self._load_deferred_initial(all_fields=True)
             # Workaround for is_anonymous becoming an attribute in Django >=1.10.
             is_anon = request_user.is_anonymous() if callable(request_user.is_anonymous) else request_user.is_anonymous
-            for field, value in self.__initial.items():
-                if value:
-                    Audit.objects.create(
-                        who=None if is_anon else request_user,
-                        model=self.__class__.__name__,
-                        model_pk=repr(self.pk),
-                        field=field, old=value,
-                    )
+            write_audits([
+                Audit(
+                    who=None if is_anon else request_user,
+                    model=self.__class__.__name__,
+                    model_pk=repr(self.pk),
+                    field=field.name, old=value,
+                )
+                for field, value in zip(self._audit_plan()[0], self._initial_snapshot())
+                if value and value is not DEFERRED
+            ])
         else:
             LOGGER.warning("Don't know deleted this: (model=%s:%s)" % (self.__class__.__name__, self.pk))
             LOGGER.warning(LOCAL_USER_WARNING)
         super(ModelChangeMixin, self).delete(*args, **kwargs)
+
+
+class AuditedQuerySet(models.QuerySet):
+    """
+    A QuerySet for models using ModelChangeMixin whose update(), bulk_update() and delete() write the same Audit
+    records as saving or deleting each of the affected instances would (without loading them). Use it like this::
+
+        objects = AuditedQuerySet.as_manager()
+
+    The model's audit_compare() is called on an unsaved instance of the model.
+    """
+
+    def _audited_values(self, fields, pks=None):
+        """
+        :param fields: the audited fields to select
+        :param pks: if given, select these rows instead of the queryset's
+        :return: a dict of the rows' audited field values tuples, keyed by pk
+        """
+        queryset = self if pks is None else self.model._base_manager.using(self.db).filter(pk__in=pks)
+        return {row[0]: row[1:] for row in queryset.values_list('pk', *[field.attname for field in fields])}
+
+    def _write_audits(self, changes):
+        """
+        Writes an Audit record per change (with a single INSERT).
+
+        :param changes: a list of (pk, field, old, new) tuples
+        """
+        if not changes:
+            return
+        model = self.model.__name__
+        request_user = get_local_user()
+        if request_user:
+            # Workaround for is_anonymous becoming an attribute in Django >=1.10.
+            is_anon = request_user.is_anonymous() if callable(request_user.is_anonymous) else request_user.is_anonymous
+            write_audits([
+                Audit(who=None if is_anon else request_user, model=model, model_pk=repr(pk), field=field.name,
+                      old=old, new=new)
+                for pk, field, old, new in changes
+            ])
+        else:
+            for pk, field, old, new in changes:
+                LOGGER.warning("Don't know who made this change: (model=%s:%s, field=%s, old='%s', new='%s')" % (
+                    model, pk, field.name, old, new
+                ))
+            LOGGER.warning(LOCAL_USER_WARNING)
+
+    def _changes(self, fields, before, after):
+        """
+        :param fields: the audited fields
+        :param before: a dict of the rows' original field values tuples, keyed by pk
+        :param after: a dict of the rows' updated field values tuples, keyed by pk
+        :return: a list of (pk, field, old, new) tuples for every audited change
+        """
+        audit_compare = self.model().audit_compare
+        return [
+            (pk, field, old, new)
+            for pk, olds in before.items() if pk in after
+            for field, old, new in zip(fields, olds, after[pk])
+            if audit_compare(field, old, new)
+        ]
+
+    def update(self, **kwargs):
+        """
+        Updates the rows and writes an Audit record per changed audited field. The original values are selected with
+        one query and (unless any of the values are expressions) the updated values aren't re-selected.
+        """
+        fields = [field for field in self.model._audit_plan()[0] if field.name in kwargs or field.attname in kwargs]
+        if not fields:
+            return super(AuditedQuerySet, self).update(**kwargs)
+
+        with transaction.atomic(using=self.db, savepoint=False):
+            before = self._audited_values(fields)
+            rows = super(AuditedQuerySet, self).update(**kwargs)
+            values = [kwargs[field.name] if field.name in kwargs else kwargs[field.attname] for field in fields]
+            if any(hasattr(value, 'resolve_expression') for value in values):
+                after = self._audited_values(fields, pks=list(before))
+            else:
+                # convert the values to what would be read back from the database
+                new = tuple(
+                    value.pk if isinstance(value, models.Model) else field.to_python(value)
+                    for field, value in zip(fields, values)
+                )
+                after = {pk: new for pk in before}
+            self._write_audits(self._changes(fields, before, after))
+        return rows
+
+    update.alters_data = True
+
+    def bulk_update(self, objs, fields, batch_size=None):
+        """
+        Updates the given fields of the given instances and writes an Audit record per changed audited field. The
+        original values are selected with one query. Each instance's initial state is reset for the given fields.
+
+        Django <2.2 doesn't have QuerySet.bulk_update() so in that case it is emulated with an UPDATE of CASE
+        expressions per batch.
+
+        :param objs: the instances to update
+        :param fields: the names of the fields to update
+        :param batch_size: optional maximum number of instances per UPDATE
+        """
+        objs = list(objs)
+        if not objs:
+            return
+        # NOTE: an internal attribute has been used when introspecting the model.
+        fields = [self.model._meta.get_field(name) for name in fields]
+        audited = [field for field in self.model._audit_plan()[0] if field in fields]
+
+        with transaction.atomic(using=self.db, savepoint=False):
+            before = self._audited_values(audited, pks=[obj.pk for obj in objs]) if audited else {}
+            if hasattr(models.QuerySet, 'bulk_update'):
+                super(AuditedQuerySet, self).bulk_update(objs, [field.name for field in fields], batch_size)
+            else:
+                batch_size = batch_size or len(objs)
+                for start in range(0, len(objs), batch_size):
+                    batch = objs[start:start + batch_size]
+                    updates = {}
+                    for field in fields:
+                        whens = []
+                        for obj in batch:
+                            value = getattr(obj, field.attname)
+                            if not hasattr(value, 'resolve_expression'):
+                                value = Value(value, output_field=field)
+                            whens.append(When(pk=obj.pk, then=value))
+                        updates[field.attname] = Case(*whens, output_field=field)
+                    models.QuerySet.update(self.filter(pk__in=[obj.pk for obj in batch]), **updates)
+            if audited:
+                after = {obj.pk: tuple(getattr(obj, field.attname) for field in audited) for obj in objs}
+                self._write_audits(self._changes(audited, before, after))
+                for obj in objs:
+                    if isinstance(obj, ModelChangeMixin):
+                        obj._reset_initial_snapshot(audited)
+
+    bulk_update.alters_data = True
+
+    def delete(self):
+        """
+        Writes an Audit record per (non-empty) audited field with 'new' set to None and deletes the rows. The
+        original values are selected with one query.
+        """
+        fields = self.model._audit_plan()[0]
+        with transaction.atomic(using=self.db, savepoint=False):
+            changes = [
+                (pk, field, value, None)
+                for pk, values in self._audited_values(fields).items()
+                for field, value in zip(fields, values) if value
+            ]
+            self._write_audits(changes)
+            return super(AuditedQuerySet, self).delete()
+
+    delete.alters_data = True
+    delete.queryset_only = True
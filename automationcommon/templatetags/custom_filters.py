@@ -1,16 +1,67 @@
 import datetime
-import dateutil
+import threading
+from collections import OrderedDict
+
+import dateutil.parser
 from django import template
+from celery.signals import task_prerun, task_postrun
+from django.contrib.auth import get_user_model
+from django.core.signals import request_started, request_finished
+from django.db.models import QuerySet
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import six
+from django.utils.dateparse import parse_datetime
 
 register = template.Library()
 
+# The renderings of users (by display_user) keyed by pk - cleared at the start and end of each request and celery
+# task and (in every thread) when any user changes.
+_memo = threading.local()
+
+# Incremented when any user changes so that every thread's memo is dropped
+_generation = 0
+
+# The maximum number of users memoised (outside of a request or task the memo is only cleared when this is reached)
+MEMO_SIZE = 1000
+
+
+def _get_display_users():
+    display_users = getattr(_memo, 'display_users', None)
+    if display_users is None or _memo.generation != _generation or len(display_users) >= MEMO_SIZE:
+        display_users = _memo.display_users = {}
+        _memo.generation = _generation
+    return display_users
+
+
+@receiver(request_started)
+@receiver(request_finished)
+@receiver(task_prerun)
+@receiver(task_postrun)
+def clear_memo(**kwargs):
+    """
+    Clears the memoised user renderings.
+    """
+    _memo.display_users = {}
+    _memo.generation = _generation
+
+
+@receiver(post_save, sender=get_user_model())
+@receiver(post_delete, sender=get_user_model())
+def _forget_users(**kwargs):
+    global _generation
+    _generation += 1
+
 
 @register.filter
 def username_list(users):
     """
-    :param users: list of django User entities
+    :param users: list (or queryset) of django User entities
     :return: a comma seperated list of crsid's
     """
+    if isinstance(users, QuerySet) and users._result_cache is None:
+        # only fetch the usernames
+        return ",".join(users.values_list('username', flat=True))
     return ",".join([user.username for user in users])
 
 
@@ -18,9 +69,15 @@ def username_list(users):
 def display_user(user):
     """
     :param user: django User
-    :return: a rendering of the user's name sand crsid
+    :return: a rendering of the user's name sand crsid (memoised for the rest of the request)
     """
-    return "%s (%s)" % (user.get_full_name(), user.username)
+    if user.pk is None:
+        return "%s (%s)" % (user.get_full_name(), user.username)
+    display_users = _get_display_users()
+    rendering = display_users.get(user.pk)
+    if rendering is None:
+        rendering = display_users[user.pk] = "%s (%s)" % (user.get_full_name(), user.username)
+    return rendering
 
 
 @register.filter
@@ -42,16 +99,63 @@ def get_item(dictionary, key):
     return dictionary.get(key, None)
 
 
+# The dates parsed by parse_date keyed by (date_str, ignore_timezone) - least recently used first
+_parsed_dates = OrderedDict()
+_parsed_dates_lock = threading.Lock()
+
+# datetime.fromisoformat() is only available from python 3.7
+_fromisoformat = getattr(datetime.datetime, 'fromisoformat', None)
+
+
 @register.filter
 def parse_date(date_str, ignore_timezone=False):
     """
+    Parses a date - trying a strptime format (if given) and then ISO 8601 before falling back to (the much slower)
+    dateutil. The MEMO_SIZE most recently used parsed dates are cached.
+
     :param date_str: a string representation of a date
-    :param ignore_timezone: if the timezone in the date_str should be ignored
+    :param ignore_timezone: if the timezone in the date_str should be ignored - or a strptime format (a string
+                            containing '%') to try first
     :return: the parsed date
     """
     if not date_str:
         return None
-    return dateutil.parser.parse(date_str).replace(tzinfo=None) if ignore_timezone else dateutil.parser.parse(date_str)
+    key = (date_str, ignore_timezone)
+    with _parsed_dates_lock:
+        parsed = _parsed_dates.get(key)
+        if parsed is not None:
+            # OrderedDict.move_to_end() was added in python 3.2
+            if hasattr(_parsed_dates, 'move_to_end'):
+                _parsed_dates.move_to_end(key)
+            else:
+                _parsed_dates[key] = _parsed_dates.pop(key)
+            return parsed
+    parsed = _parse_date(date_str, ignore_timezone)
+    with _parsed_dates_lock:
+        _parsed_dates[key] = parsed
+        while len(_parsed_dates) > MEMO_SIZE:
+            _parsed_dates.popitem(last=False)
+    return parsed
+
+
+def _parse_date(date_str, ignore_timezone):
+    if isinstance(ignore_timezone, six.string_types) and '%' in ignore_timezone:
+        try:
+            return datetime.datetime.strptime(date_str, ignore_timezone)
+        except ValueError:
+            # a format is not a request to ignore the timezone
+            ignore_timezone = False
+    parsed = None
+    try:
+        if _fromisoformat is not None:
+            parsed = _fromisoformat(date_str[:-1] + '+00:00' if date_str.endswith('Z') else date_str)
+        else:
+            parsed = parse_datetime(date_str)
+    except ValueError:
+        pass
+    if parsed is None:
+        parsed = dateutil.parser.parse(date_str)
+    return parsed.replace(tzinfo=None) if ignore_timezone else parsed
 
 
 @register.filter
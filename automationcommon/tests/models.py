@@ -0,0 +1,19 @@
+from django.conf import settings
+from django.db import models
+
+from automationcommon.models import ModelChangeMixin, AuditedQuerySet
+
+
+class Window(ModelChangeMixin, models.Model):
+    """
+    An audited model used to test ModelChangeMixin against a real table.
+    """
+    name = models.CharField(max_length=64)
+
+    description = models.CharField(max_length=255, blank=True)
+
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL)
+
+    modified = models.DateTimeField(auto_now=True)
+
+    objects = AuditedQuerySet.as_manager()
@@ -0,0 +1,96 @@
+import datetime
+import gzip
+import json
+import os
+import shutil
+import tempfile
+
+import mock
+from django.core.management import call_command
+from django.utils import timezone
+from django.utils.six import StringIO
+
+from automationcommon.management.commands.archive_audit import Command
+from automationcommon.models import Audit
+from automationcommon.tests.utils import UnitTestCase
+
+
+class ArchiveAuditTests(UnitTestCase):
+
+    def setUp(self):
+        super(ArchiveAuditTests, self).setUp()
+        self.output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_dir)
+        self.now = timezone.now()
+
+    def create_audit(self, days, model_pk='1', field='name', old=None, new=None):
+        return Audit.objects.create(
+            when=self.now - datetime.timedelta(days=days), model='Window', model_pk=model_pk, field=field,
+            old=old, new=new
+        )
+
+    def test_archive(self):
+        """check that old records are archived to a file and deleted"""
+        old = [self.create_audit(400 + i, old=str(i)) for i in range(5)]
+        recent = self.create_audit(10)
+
+        # test
+        call_command('archive_audit', days=365, output_dir=self.output_dir, chunk_size=2, stdout=StringIO())
+
+        # check
+        self.assertEqual([recent], list(Audit.objects.all()))
+        files = os.listdir(self.output_dir)
+        self.assertEqual(1, len(files))
+        with gzip.open(os.path.join(self.output_dir, files[0]), 'rb') as archive:
+            rows = [json.loads(line.decode('utf-8')) for line in archive]
+        self.assertEqual([audit.id for audit in old], [row['id'] for row in rows])
+        self.assertEqual([audit.old for audit in old], [row['old'] for row in rows])
+        self.assertEqual(old[0].when.isoformat(), rows[0]['when'])
+
+    def test_archive_nothing(self):
+        """check that no file is written if there is nothing to archive"""
+        self.create_audit(10)
+
+        # test
+        call_command('archive_audit', output_dir=self.output_dir, stdout=StringIO())
+
+        # check
+        self.assertEqual(1, Audit.objects.count())
+        self.assertEqual([], os.listdir(self.output_dir))
+
+    def test_compact(self):
+        """check that consecutive changes to the same field are collapsed"""
+        self.create_audit(100, old='a', new='b')
+        self.create_audit(99, old='b', new='c')
+        last = self.create_audit(98, old='c', new='d')
+        other_field = self.create_audit(97, field='description', old='x', new='y')
+        other_pk = self.create_audit(96, model_pk='2', old='p', new='q')
+        recent = self.create_audit(1, old='d', new='e')
+
+        # test
+        call_command('archive_audit', output_dir=self.output_dir, compact_days=30, stdout=StringIO())
+
+        # check
+        self.assertEqual(
+            [(last.id, 'a', 'd'), (other_field.id, 'x', 'y'), (other_pk.id, 'p', 'q'), (recent.id, 'd', 'e')],
+            list(Audit.objects.order_by('id').values_list('id', 'old', 'new'))
+        )
+
+    def test_compact_chunked(self):
+        """check that runs are collapsed as they are found (one transaction per chunk of runs)"""
+        self.create_audit(100, old='a', new='b')
+        first = self.create_audit(99, old='b', new='c')
+        self.create_audit(98, model_pk='2', old='p', new='q')
+        self.create_audit(97, model_pk='2', old='q', new='r')
+        second = self.create_audit(96, model_pk='2', old='r', new='s')
+
+        # test
+        with mock.patch.object(Command, 'collapse_runs', wraps=Command.collapse_runs) as collapse_runs:
+            call_command('archive_audit', output_dir=self.output_dir, compact_days=30, chunk_size=1, stdout=StringIO())
+
+        # check
+        self.assertEqual(2, collapse_runs.call_count)
+        self.assertEqual(
+            [(first.id, 'a', 'c'), (second.id, 'p', 's')],
+            list(Audit.objects.order_by('id').values_list('id', 'old', 'new'))
+        )
@@ -0,0 +1,320 @@
+import json
+import threading
+import time
+
+import mock
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+
+from automationcommon import health
+from automationcommon.utils import refresh_status_snapshot
+
+
+class HealthTests(TestCase):
+
+    def tearDown(self):
+        health._soap_proxies.clear()
+
+    def test_run_checks(self):
+        """check that checks are run concurrently and that their results and latencies are returned"""
+
+        def slow_check():
+            time.sleep(0.2)
+            return True
+
+        def failing_check():
+            raise IOError("down")
+
+        # test
+        start = time.time()
+        results = health.run_checks({'slow1': slow_check, 'slow2': slow_check, 'failing': failing_check})
+
+        # check
+        self.assertLess(time.time() - start, 0.4)
+        self.assertEqual({'slow1': True, 'slow2': True, 'failing': False},
+                         dict((name, result[0]) for name, result in results.items()))
+        self.assertGreaterEqual(results['slow1'][1], 0.2)
+
+    def test_run_checks_timeout(self):
+        """check that a check that doesn't finish in time fails"""
+
+        def hung_check():
+            time.sleep(1)
+            return True
+
+        # test
+        start = time.time()
+        results = health.run_checks({'hung': hung_check, 'ok': lambda: True}, timeout=0.1)
+
+        # check
+        self.assertLess(time.time() - start, 0.5)
+        self.assertFalse(results['hung'][0])
+        self.assertTrue(results['ok'][0])
+
+    @override_settings(SERVICE_CHECKS={'REST': 'https://rest.example.com/', 'Other': 'https://other.example.com/'},
+                       SERVICE_CHECK_TIMEOUT=2)
+    def test_run_service_checks(self):
+        """check that REST services are checked with a timeout"""
+
+        def get(url, timeout):
+            return mock.Mock(status_code=200 if url == 'https://rest.example.com/' else 404)
+
+        # test
+        with mock.patch.object(health.get_session(), 'get', side_effect=get) as mock_get:
+            results = health.run_service_checks()
+
+        # check
+        self.assertTrue(results['REST'][0])
+        self.assertFalse(results['Other'][0])
+        mock_get.assert_any_call('https://rest.example.com/', timeout=2)
+
+    def test_get_session(self):
+        """check that the session is shared but not with forked processes"""
+
+        session = health.get_session()
+        self.assertIs(session, health.get_session())
+        with mock.patch('automationcommon.health.os.getpid', return_value=-1):
+            self.assertIsNot(session, health.get_session())
+
+    @override_settings(SERVICE_CHECK_WSDL_TTL=60)
+    def test_get_soap_proxy(self):
+        """check that the SOAP client for a service is cached until the TTL expires"""
+        service = {'url': 'https://soap.example.com/?wsdl', 'name': 'Service', 'operation': 'Ping'}
+
+        with mock.patch('automationcommon.health.Client') as mock_client:
+            mock_client.return_value.bind.side_effect = lambda **kwargs: mock.MagicMock()
+
+            # test
+            proxy = health.get_soap_proxy(service, 5)
+
+            # check
+            self.assertIs(proxy, health.get_soap_proxy(service, 5))
+            self.assertEqual(1, mock_client.call_count)
+
+            # test
+            with mock.patch('automationcommon.health.time.time', return_value=time.time() + 61):
+                self.assertIsNot(proxy, health.get_soap_proxy(service, 5))
+
+            # check
+            self.assertEqual(2, mock_client.call_count)
+
+    def test_check_service_soap(self):
+        """check that a SOAP service's operation is called and that its proxy is dropped if the call fails"""
+        service = {'url': 'https://soap.example.com/?wsdl', 'name': 'Service', 'operation': 'Ping'}
+
+        with mock.patch('automationcommon.health.Client') as mock_client:
+            proxy = mock.MagicMock()
+            mock_client.return_value.bind.return_value = proxy
+
+            # test/check
+            self.assertTrue(health.check_service(service, 3))
+            proxy.__getitem__.assert_called_with('Ping')
+            mock_client.return_value.bind.assert_called_with(service_name='Service', port_name='ServiceSoap12')
+
+            # test/check
+            proxy.__getitem__.return_value.side_effect = IOError('down')
+            with self.assertRaises(IOError):
+                health.check_service(service, 3)
+            self.assertNotIn((service['url'], 'Service', 3), health._soap_proxies)
+
+    def test_check_database(self):
+        """check that the database check works"""
+        self.assertTrue(health.check_database())
+
+    @override_settings(SERVICE_CHECKS={}, STATUS_DATABASES=['default', 'replica'])
+    def test_run_all_checks_databases(self):
+        """check that all the STATUS_DATABASES are checked and that the thread connections are closed"""
+
+        calls = []
+
+        def check_database(alias='default', close=False):
+            calls.append((alias, close, threading.current_thread()))
+            time.sleep(0.2)
+            return alias == 'default'
+
+        # test
+        start = time.time()
+        with mock.patch('automationcommon.health.check_database', side_effect=check_database):
+            results = health.run_all_checks()
+
+        # check
+        self.assertLess(time.time() - start, 0.6)
+        self.assertEqual({'Database': True, 'Database (replica)': False},
+                         dict((name, result[0]) for name, result in results.items()))
+        # the default database is checked on the long lived thread (with its persistent connection)
+        self.assertEqual(
+            [('default', False, 'status-database'), ('replica', True, 'status-check-Database (replica)')],
+            sorted((alias, close, thread.name) for alias, close, thread in calls)
+        )
+        health._metrics.clear()
+
+    @override_settings(SERVICE_CHECKS={}, SERVICE_CHECK_TIMEOUT=0.2)
+    def test_run_all_checks_default_database_hung(self):
+        """check that a hung default database fails the check within the timeout"""
+
+        hung = threading.Event()
+
+        def check_database(alias='default', close=False):
+            hung.wait(2)
+            return True
+
+        # test
+        start = time.time()
+        with mock.patch('automationcommon.health.check_database', side_effect=check_database):
+            results = health.run_all_checks()
+            second_results = health.run_all_checks()
+            # the third check can't be queued behind the hung one and its queued successor
+            third_results = health.run_all_checks()
+            hung.set()
+
+        # check
+        self.assertLess(time.time() - start, 1.5)
+        self.assertFalse(results['Database'][0])
+        self.assertFalse(second_results['Database'][0])
+        self.assertFalse(third_results['Database'][0])
+        self.assertLess(third_results['Database'][1], 0.1)
+        health._metrics.clear()
+
+
+@override_settings(SERVICE_CHECKS={}, SERVICE_CHECK_INTERVAL=30)
+class StatusSnapshotTests(TestCase):
+
+    def setUp(self):
+        cache.delete(health.STATUS_CACHE_KEY)
+        patcher = mock.patch('automationcommon.health.start_refresher')
+        self.start_refresher = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @override_settings(SERVICE_CHECK_INTERVAL=None)
+    def test_get_status_no_interval(self):
+        """check that the checks are run when there's no interval"""
+
+        # test
+        results, age = health.get_status()
+
+        # check
+        self.assertTrue(results['Database'][0])
+        self.assertIsNone(age)
+        self.assertIsNone(cache.get(health.STATUS_CACHE_KEY))
+        self.start_refresher.assert_not_called()
+
+    def test_get_status(self):
+        """check that the snapshot is used (and the refresher is started)"""
+        cache.set(health.STATUS_CACHE_KEY, {'results': {'Database': (True, 0.01)}, 'timestamp': time.time() - 10})
+
+        # test
+        with mock.patch('automationcommon.health.run_all_checks') as run_all_checks:
+            results, age = health.get_status()
+
+        # check
+        run_all_checks.assert_not_called()
+        self.start_refresher.assert_called_once_with(30)
+        self.assertEqual({'Database': (True, 0.01)}, results)
+        self.assertAlmostEqual(10, age, delta=1)
+
+    def test_get_status_missing(self):
+        """check that the snapshot is refreshed if there isn't one"""
+
+        # test
+        results, age = health.get_status()
+
+        # check
+        self.assertTrue(results['Database'][0])
+        self.assertEqual(results, cache.get(health.STATUS_CACHE_KEY)['results'])
+
+    def test_get_status_stale(self):
+        """check that the status fails if the snapshot is too old"""
+        cache.set(health.STATUS_CACHE_KEY, {'results': {'Database': (True, 0.01)}, 'timestamp': time.time() - 100})
+
+        # test
+        results, age = health.get_status()
+
+        # check
+        self.assertEqual({'Database': (True, 0.01), 'Status snapshot': (False, 0)}, results)
+
+    @override_settings(SERVICE_CHECK_REFRESHER='celery')
+    def test_refresh_status_snapshot(self):
+        """check that the celery task refreshes the snapshot (and that the refresher thread isn't started)"""
+
+        # test
+        refresh_status_snapshot()
+        results, age = health.get_status()
+
+        # check
+        self.assertTrue(results['Database'][0])
+        self.start_refresher.assert_not_called()
+
+
+@override_settings(SERVICE_CHECKS={}, SERVICE_CHECK_BUCKETS=(0.1, 1))
+class StatusMetricsTests(TestCase):
+
+    STATUS_URL = '/status/20d47308-dd08-4aa6-991c-c46a6e7fced7/'
+
+    def tearDown(self):
+        health._metrics.clear()
+
+    def test_record_metrics(self):
+        """check that latencies are added to cumulative histograms and that failures are counted"""
+
+        # test
+        health.record_metrics({'A': (True, 0.05), 'B': (False, 5)})
+        health.record_metrics({'A': (True, 0.5)})
+
+        # check
+        metrics = health.get_metrics()
+        self.assertEqual([1, 2], metrics['A']['counts'])
+        self.assertEqual(2, metrics['A']['count'])
+        self.assertAlmostEqual(0.55, metrics['A']['sum'])
+        self.assertEqual(0, metrics['A']['errors'])
+        self.assertEqual([0, 0], metrics['B']['counts'])
+        self.assertEqual(1, metrics['B']['errors'])
+
+    def test_status_as_prometheus(self):
+        """check the Prometheus text format"""
+        health.record_metrics({'A "1"': (False, 0.5), 'Database': (True, 0.05)})
+
+        # test
+        text = health.status_as_prometheus({'A "1"': (False, 0.5), 'Database': (True, 0.05)}, age=3)
+
+        # check
+        lines = text.splitlines()
+        self.assertIn('automationcommon_check_up{check="A \\"1\\""} 0', lines)
+        self.assertIn('automationcommon_check_up{check="Database"} 1', lines)
+        self.assertIn('automationcommon_check_latency_seconds{check="A \\"1\\""} 0.5', lines)
+        self.assertIn('automationcommon_check_duration_seconds_bucket{check="A \\"1\\"",le="0.1"} 0', lines)
+        self.assertIn('automationcommon_check_duration_seconds_bucket{check="A \\"1\\"",le="1.0"} 1', lines)
+        self.assertIn('automationcommon_check_duration_seconds_bucket{check="A \\"1\\"",le="+Inf"} 1', lines)
+        self.assertIn('automationcommon_check_duration_seconds_count{check="Database"} 1', lines)
+        self.assertIn('automationcommon_check_errors_total{check="A \\"1\\""} 1', lines)
+        self.assertIn('automationcommon_database_ping_seconds{alias="default"} 0.05', lines)
+        self.assertIn('automationcommon_status_snapshot_age_seconds 3.0', lines)
+
+    def test_status_json(self):
+        """check that the status page returns JSON when asked"""
+
+        # test
+        response = self.client.get(self.STATUS_URL, HTTP_ACCEPT='application/json')
+
+        # check
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('application/json', response['Content-Type'])
+        status = json.loads(response.content.decode('utf-8'))
+        self.assertTrue(status['up'])
+        self.assertTrue(status['checks']['Database']['up'])
+        self.assertEqual(0, status['checks']['Database']['errors'])
+        self.assertEqual(1, status['checks']['Database']['histogram']['count'])
+        self.assertEqual({'default': status['checks']['Database']['latency']}, status['database_ping'])
+
+    @override_settings(SERVICE_CHECKS={'REST': 'https://rest.example.com/'})
+    def test_status_metrics(self):
+        """check that the metrics page returns a 200 (in the Prometheus text format) even if a check fails"""
+
+        # test
+        with mock.patch.object(health.get_session(), 'get', return_value=mock.Mock(status_code=503)):
+            response = self.client.get(self.STATUS_URL + 'metrics/')
+
+        # check
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertIn(b'automationcommon_check_up{check="REST"} 0\n', response.content)
+        self.assertIn(b'automationcommon_check_errors_total{check="REST"} 1\n', response.content)
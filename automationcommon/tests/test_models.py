@@ -4,11 +4,18 @@ import logging
 import mock
 
 from django.contrib.auth.models import User, AnonymousUser
+from django.db.models import F
+from django.db.models.functions import Concat
+from django.db import transaction
+from django.test import TransactionTestCase, override_settings
 from testfixtures import LogCapture
 
 from automationcommon.models import (
-    set_local_user, Audit, ModelChangeMixin, clear_local_user, LOCAL_USER_WARNING
+    set_local_user, get_local_user, Audit, ModelChangeMixin, clear_local_user, LOCAL_USER_WARNING, audit_batch,
+    start_audit_batch, flush_audit_batch
 )
+from automationcommon.tests.models import Window
+from automationcommon.utils import write_audit_records
 from automationcommon.tests.utils import UnitTestCase
 
 
@@ -31,8 +38,10 @@ class FakeMeta:
             'other': True
         }
 
-    def get_field(self, name):
-        return self.fields[name]
+
+class FakeField:
+    def __init__(self, name):
+        self.name = name
 
 
 class FakeState:
@@ -46,12 +55,15 @@ class TestModel(ModelChangeMixin, FakeModel):
         self._state = FakeState()
         super(TestModel, self).__init__(*args, **kwargs)
 
-    @property
-    def _dict(self):
-        return self._meta.fields.copy()
+    def _audit_plan(self):
+        names = sorted(self._meta.fields)
+        return (
+            tuple(FakeField(name) for name in names),
+            lambda obj: tuple(obj._meta.fields[name] for name in names)
+        )
 
     def audit_compare(self, field, old, new):
-        if isinstance(field, bool):
+        if field.name == 'other':
             return False
         return super(TestModel, self).audit_compare(field, old, new)
 
@@ -138,6 +150,51 @@ class ModelsTests(UnitTestCase):
         self.assertEqual("the round window", audits[1].old)
         self.assertEqual("the square window", audits[1].new)
 
+    def test_audit_multiple_change_single_insert(self):
+        """check that all the changes for a save are written together"""
+
+        # test
+        with mock.patch.object(Audit.objects, 'bulk_create', wraps=Audit.objects.bulk_create) as bulk_create:
+            self.test_model._meta.fields.update({
+                'name': 'the square window',
+                'description': "no wait, it's actually square!",
+            })
+            self.test_model.save()
+
+        # check
+        bulk_create.assert_called_once()
+        self.assertEqual(2, Audit.objects.count())
+
+    def test_audit_batch(self):
+        """check that audit_batch() buffers the records of several saves and writes them together"""
+
+        # test
+        with mock.patch('automationcommon.models.transaction.on_commit', side_effect=lambda func: func()), \
+                mock.patch.object(Audit.objects, 'bulk_create', wraps=Audit.objects.bulk_create) as bulk_create:
+            with audit_batch():
+                self.test_model._meta.fields.update({'name': 'the square window'})
+                self.test_model.save()
+                self.test_model._meta.fields.update({'description': "no wait, it's actually square!"})
+                self.test_model.save()
+                self.assertEqual(0, Audit.objects.count())
+
+        # check
+        bulk_create.assert_called_once()
+        self.assertEqual(2, Audit.objects.count())
+
+    def test_audit_batch_exception(self):
+        """check that the buffered records are dropped if an exception is raised"""
+
+        # test
+        with self.assertRaises(ValueError):
+            with audit_batch():
+                self.test_model._meta.fields.update({'name': 'the square window'})
+                self.test_model.save()
+                raise ValueError()
+
+        # check
+        self.assertEqual(0, Audit.objects.count())
+
     def test_audit_delete(self):
 
         # test
@@ -159,6 +216,78 @@ class ModelsTests(UnitTestCase):
         self.assertTrue(audits[3].old)
         self.assertIsNone(audits[3].new)
 
+    @override_settings(AUDIT_ASYNC=True)
+    def test_audit_async(self):
+        """check that the records are queued when AUDIT_ASYNC is set"""
+
+        start = datetime.datetime.now()
+
+        # test
+        with mock.patch('automationcommon.models.transaction.on_commit', side_effect=lambda func: func()), \
+                mock.patch('automationcommon.utils.write_audit_records.delay') as delay:
+            self.test_model._meta.fields.update({'description': "it's a round window"})
+            self.test_model.save()
+
+        # check
+        self.assertEqual(0, Audit.objects.count())
+        delay.assert_called_once()
+        records = delay.call_args[0][0]
+        self.assertEqual(1, len(records))
+
+        # test
+        write_audit_records(records)
+
+        # check
+        audit = Audit.objects.get()
+        self.assertLessEqual(start, audit.when)
+        self.assertEqual(Audit.from_record(records[0]).when, audit.when)
+        self.assertEqual(self.user, audit.who)
+        self.assertEqual('TestModel', audit.model)
+        self.assertEqual('1', audit.model_pk)
+        self.assertEqual('description', audit.field)
+        self.assertEqual("it's round", audit.old)
+        self.assertEqual("it's a round window", audit.new)
+
+    @override_settings(AUDIT_ASYNC=True)
+    def test_audit_async_fallback(self):
+        """check that the records are written straight away if they can't be queued"""
+
+        # test
+        with mock.patch('automationcommon.models.transaction.on_commit', side_effect=lambda func: func()), \
+                mock.patch('automationcommon.utils.write_audit_records.delay', side_effect=IOError('no broker')), \
+                LogCapture(level=logging.WARNING) as log_capture:
+            self.test_model._meta.fields.update({'description': "it's a round window"})
+            self.test_model.save()
+
+        # check
+        self.assertEqual(1, Audit.objects.count())
+        log_capture.check((
+            'automationcommon', 'WARNING', "Couldn't queue 1 audit records (no broker) - writing them now"
+        ))
+
+    def test_local_user_cached(self):
+        """check that the local user isn't re-queried for every save"""
+
+        # test
+        with self.assertNumQueries(0):
+            user = get_local_user()
+
+        # check
+        self.assertIs(user, self.user)
+
+    def test_local_user_invalidated(self):
+        """check that the local user is reloaded (once) after it has changed"""
+
+        # test
+        with mock.patch('ucamlookup.signals.return_visibleName_by_crsid', return_value='Ivanna Tinkle'):
+            User.objects.get(pk=self.user.pk).save()
+        with self.assertNumQueries(1):
+            user = get_local_user()
+            get_local_user()
+
+        # check
+        self.assertEqual(user, self.user)
+        self.assertIsNot(user, self.user)
 
     def test_audit_compare_override(self):
         """check that any changes to the 'other' field are ignored because of audit_compare()"""
@@ -172,3 +301,308 @@ class ModelsTests(UnitTestCase):
 
     def tearDown(self):
         clear_local_user()
+
+
+class ModelChangeMixinTests(UnitTestCase):
+
+    def setUp(self):
+        super(ModelChangeMixinTests, self).setUp()
+        self.user = User.objects.create(username="it123")
+        set_local_user(self.user)
+        self.window = Window.objects.create(name='the round window', description="it's round")
+
+    def test_audit_plan(self):
+        """check that the plan has the editable fields and is computed once per class"""
+
+        fields, getter = Window._audit_plan()[:2]
+
+        self.assertEqual(['id', 'name', 'description', 'owner'], [field.name for field in fields])
+        self.assertIs(Window._audit_plan(), Window._audit_plan())
+        self.assertEqual((self.window.pk, 'the round window', "it's round", None), getter(self.window))
+
+    def test_diffs(self):
+        """check that changed fields (including foreign keys) are reported by position"""
+
+        # test
+        self.window.description = "it's a round window"
+        self.window.owner = self.user
+
+        # check
+        self.assertEqual([
+            ('description', ("it's round", "it's a round window")),
+            ('owner', (None, self.user.pk)),
+        ], self.window.diffs)
+
+    def test_save_loaded(self):
+        """check that changes to an instance loaded from the database are audited"""
+
+        # test
+        window = Window.objects.get(pk=self.window.pk)
+        window.name = 'the square window'
+        window.save()
+
+        # check
+        self.assertEqual(1, Audit.objects.count())
+        audit = Audit.objects.get()
+        self.assertEqual('Window', audit.model)
+        self.assertEqual('name', audit.field)
+        self.assertEqual('the round window', audit.old)
+        self.assertEqual('the square window', audit.new)
+        self.assertEqual([], window.diffs)
+
+    def test_lazy_save_loaded(self):
+        """check that the initial state of a lazy instance is only captured when needed"""
+
+        with mock.patch.object(Window, 'audit_lazy', True):
+
+            # test
+            window = Window.objects.get(pk=self.window.pk)
+            self.assertIsNone(window._ModelChangeMixin__initial)
+            window.name = 'the square window'
+            window.save()
+
+        # check
+        audit = Audit.objects.get()
+        self.assertEqual('name', audit.field)
+        self.assertEqual('the round window', audit.old)
+        self.assertEqual('the square window', audit.new)
+        self.assertEqual([], window.diffs)
+
+    def test_deferred(self):
+        """check that changes to an instance with deferred fields are audited without loading the deferred fields"""
+
+        for audit_lazy in (False, True):
+            Audit.objects.all().delete()
+            with mock.patch.object(Window, 'audit_lazy', audit_lazy):
+
+                # test
+                window = Window.objects.only('name').get(pk=self.window.pk)
+                window.name = 'the square window'
+                with self.assertNumQueries(2):
+                    window.save()
+
+            # check
+            audit = Audit.objects.get()
+            self.assertEqual('name', audit.field)
+            self.assertEqual('the round window', audit.old)
+            self.assertEqual('the square window', audit.new)
+            Window.objects.update(name='the round window')
+
+    def test_deferred_assigned(self):
+        """check that a change to a deferred field is audited (with its original value loaded before the save)"""
+
+        for audit_lazy in (False, True):
+            Audit.objects.all().delete()
+            with mock.patch.object(Window, 'audit_lazy', audit_lazy):
+
+                # test
+                window = Window.objects.only('name').get(pk=self.window.pk)
+                window.description = 'changed'
+                window.save()
+
+            # check
+            audit = Audit.objects.get()
+            self.assertEqual('description', audit.field)
+            self.assertEqual("it's round", audit.old)
+            self.assertEqual('changed', audit.new)
+            Window.objects.update(description="it's round")
+
+    def test_deferred_delete(self):
+        """check that the deferred fields of a deleted instance are audited"""
+
+        # test
+        Window.objects.only('name').get(pk=self.window.pk).delete()
+
+        # check
+        self.assertEqual({'name': 'the round window', 'description': "it's round"}, dict(
+            (audit.field, audit.old) for audit in Audit.objects.filter(field__in=('name', 'description'))
+        ))
+
+    def tearDown(self):
+        clear_local_user()
+
+
+class AuditedQuerySetTests(UnitTestCase):
+
+    def setUp(self):
+        super(AuditedQuerySetTests, self).setUp()
+        self.user = User.objects.create(username="it123")
+        set_local_user(self.user)
+        self.round = Window.objects.create(name='the round window', description="it's round")
+        self.square = Window.objects.create(name='the square window', description="it's square")
+
+    def assert_audits(self, expected):
+        self.assertEqual(sorted(expected), sorted(
+            (audit.model_pk, audit.field, audit.old, audit.new) for audit in Audit.objects.all()
+        ))
+        for audit in Audit.objects.all():
+            self.assertEqual('Window', audit.model)
+            self.assertEqual(self.user, audit.who)
+
+    def test_update(self):
+        """check that an update is audited with a single SELECT and INSERT"""
+
+        # test
+        with self.assertNumQueries(3):
+            rows = Window.objects.all().update(description="it's a window", owner=self.user)
+
+        # check
+        self.assertEqual(2, rows)
+        self.assert_audits([
+            (repr(self.round.pk), 'description', "it's round", "it's a window"),
+            (repr(self.round.pk), 'owner', None, str(self.user.pk)),
+            (repr(self.square.pk), 'description', "it's square", "it's a window"),
+            (repr(self.square.pk), 'owner', None, str(self.user.pk)),
+        ])
+
+    def test_update_unchanged(self):
+        """check that fields that aren't changed by an update aren't audited"""
+
+        # test
+        Window.objects.filter(pk=self.round.pk).update(name='the round window', description="it's a window")
+
+        # check
+        self.assert_audits([(repr(self.round.pk), 'description', "it's round", "it's a window")])
+
+    def test_update_expression(self):
+        """check that the updated values are re-selected when they are expressions"""
+
+        # test
+        Window.objects.filter(pk=self.square.pk).update(description=Concat(F('description'), F('name')))
+
+        # check
+        self.assert_audits([
+            (repr(self.square.pk), 'description', "it's square", "it's squarethe square window")
+        ])
+
+    def test_update_not_audited(self):
+        """check that updating fields that aren't audited doesn't select anything"""
+
+        # test
+        with self.assertNumQueries(1):
+            Window.objects.update(modified=datetime.datetime.now())
+
+        # check
+        self.assertEqual(0, Audit.objects.count())
+
+    def test_bulk_update(self):
+        """check that bulk_update() updates and audits the instances and resets their initial state"""
+        self.round.name = 'the big round window'
+        self.square.name = 'the big square window'
+        self.square.description = 'not saved'
+
+        # test
+        Window.objects.bulk_update([self.round, self.square], ['name'])
+
+        # check
+        self.assertEqual(
+            ['the big round window', 'the big square window'],
+            list(Window.objects.order_by('pk').values_list('name', flat=True))
+        )
+        self.assertEqual("it's square", Window.objects.get(pk=self.square.pk).description)
+        self.assert_audits([
+            (repr(self.round.pk), 'name', 'the round window', 'the big round window'),
+            (repr(self.square.pk), 'name', 'the square window', 'the big square window'),
+        ])
+        self.assertEqual([], self.round.diffs)
+        self.assertEqual([('description', ("it's square", 'not saved'))], self.square.diffs)
+
+    def test_history_for(self):
+        """check that an instance's history is returned newest first and can be paged by keyset"""
+        Window.objects.update(description="it's a window")
+        Window.objects.filter(pk=self.round.pk).update(name='the big round window')
+        Audit.objects.filter(field='name').update(when=datetime.datetime.now() + datetime.timedelta(minutes=1))
+
+        # test
+        history = Audit.objects.history_for(self.round)
+        with self.assertNumQueries(2):
+            page1 = list(history[:1])
+            page2 = list(history.before(page1[-1])[:1])
+
+        # check
+        self.assertEqual(2, history.count())
+        self.assertEqual(['name'], [audit.field for audit in page1])
+        self.assertEqual(['description'], [audit.field for audit in page2])
+        self.assertFalse(history.before(page2[-1]).exists())
+
+    def test_history_for_model(self):
+        """check that all of a model's history is returned newest first"""
+        Window.objects.update(description="it's a window")
+        since = datetime.datetime.now()
+        Window.objects.filter(pk=self.square.pk).update(name='the big square window')
+
+        # test
+        history = Audit.objects.history_for_model(Window)
+
+        # check
+        self.assertEqual([
+            ('name', repr(self.square.pk)),
+            ('description', repr(self.square.pk)),
+            ('description', repr(self.round.pk)),
+        ], [(audit.field, audit.model_pk) for audit in history])
+        self.assertEqual(['name'], [audit.field for audit in Audit.objects.history_for_model(Window, since=since)])
+
+    def test_delete(self):
+        """check that a delete audits the non-empty fields of every row"""
+
+        # test
+        Window.objects.filter(pk=self.round.pk).delete()
+
+        # check
+        self.assertFalse(Window.objects.filter(pk=self.round.pk).exists())
+        self.assert_audits([
+            (repr(self.round.pk), 'id', str(self.round.pk), None),
+            (repr(self.round.pk), 'name', 'the round window', None),
+            (repr(self.round.pk), 'description', "it's round", None),
+        ])
+
+    def tearDown(self):
+        clear_local_user()
+
+
+class AuditBatchTransactionTests(TransactionTestCase):
+
+    def setUp(self):
+        set_local_user(AnonymousUser())
+        self.window = Window.objects.create(name='round')
+
+    def test_audit_batch_rollback(self):
+        """check that the buffered records of a change that is rolled back are dropped"""
+
+        # test
+        start_audit_batch()
+        try:
+            with self.assertRaises(ValueError):
+                with transaction.atomic():
+                    self.window.name = 'square'
+                    self.window.save()
+                    raise ValueError()
+            window = Window.objects.get()
+            window.description = 'committed'
+            with transaction.atomic():
+                window.save()
+        finally:
+            flush_audit_batch()
+
+        # check
+        self.assertEqual('round', Window.objects.get().name)
+        self.assertEqual([('description', '', 'committed')], [
+            (audit.field, audit.old, audit.new) for audit in Audit.objects.all()
+        ])
+
+    def test_audit_batch_atomic(self):
+        """check that the records of a change made in an atomic block that the batch is flushed in are written"""
+
+        # test
+        with transaction.atomic(), audit_batch():
+            self.window.name = 'square'
+            self.window.save()
+
+        # check
+        self.assertEqual('square', Window.objects.get().name)
+        self.assertEqual([('name', 'round', 'square')], [
+            (audit.field, audit.old, audit.new) for audit in Audit.objects.all()
+        ])
+
+    def tearDown(self):
+        clear_local_user()
@@ -1,4 +1,12 @@
+import datetime
+import threading
+
+import mock
+from celery.signals import task_prerun
 from django.contrib.auth.models import User
+from django.core.signals import request_started
+from django.db.models.signals import post_save
+from django.utils.timezone import get_fixed_timezone
 
 import automationcommon.templatetags.custom_filters as custom_filters
 from automationcommon.tests.utils import UnitTestCase
@@ -13,10 +21,78 @@ class CustomFilterTests(UnitTestCase):
         User.objects.create(username="it123")
         self.assertEqual(custom_filters.username_list(User.objects.all()), "bl123,it123")
 
+    def test_username_list_values(self):
+        User.objects.create(username="bl123")
+        User.objects.create(username="it123")
+        with self.assertNumQueries(1):
+            self.assertEqual(custom_filters.username_list(User.objects.order_by('username')), "bl123,it123")
+
     def test_display_user(self):
         user = User.objects.create(username="bl123")
         self.assertEqual(custom_filters.display_user(user), "Bill Loney (bl123)")
 
+    def test_display_user_memoised(self):
+        user = User.objects.create(username="bl123")
+        request_started.send(sender=None)
+        self.assertEqual(custom_filters.display_user(user), "Bill Loney (bl123)")
+        user.last_name = "Changed"
+        self.assertEqual(custom_filters.display_user(user), "Bill Loney (bl123)")
+        # the memo is cleared when the user is saved
+        user.save()
+        self.assertEqual(custom_filters.display_user(User.objects.get(pk=user.pk)), "Bill Loney (bl123)")
+        # and at the start of each request
+        User.objects.filter(pk=user.pk).update(last_name="Changed")
+        request_started.send(sender=None)
+        self.assertEqual(custom_filters.display_user(User.objects.get(pk=user.pk)), "Changed (bl123)")
+
     def test_unique_entity_id(self):
         user = User.objects.create(username="bl123")
         self.assertEqual(custom_filters.unique_entity_id(user), "User-%s" % user.id)
+
+    def test_display_user_memo_cleared(self):
+        user = User.objects.create(username="bl123")
+        request_started.send(sender=None)
+        self.assertEqual(custom_filters.display_user(user), "Bill Loney (bl123)")
+        User.objects.filter(pk=user.pk).update(last_name="Changed")
+        # the memo is cleared before each celery task
+        task_prerun.send(sender=None)
+        self.assertEqual(custom_filters.display_user(User.objects.get(pk=user.pk)), "Changed (bl123)")
+        # and in every thread when a user changes in any thread
+        User.objects.filter(pk=user.pk).update(last_name="Changed again")
+        thread = threading.Thread(target=post_save.send, kwargs={'sender': User, 'instance': user, 'created': False})
+        thread.start()
+        thread.join()
+        self.assertEqual(custom_filters.display_user(User.objects.get(pk=user.pk)), "Changed again (bl123)")
+
+    def test_parse_date(self):
+        self.assertIsNone(custom_filters.parse_date(""))
+        self.assertEqual(custom_filters.parse_date("2018-01-02T03:04:05+01:00"),
+                         datetime.datetime(2018, 1, 2, 3, 4, 5, tzinfo=get_fixed_timezone(60)))
+        self.assertEqual(custom_filters.parse_date("2018-01-02T03:04:05+01:00", True),
+                         datetime.datetime(2018, 1, 2, 3, 4, 5))
+        self.assertEqual(custom_filters.parse_date("2 January 2018"), datetime.datetime(2018, 1, 2))
+        self.assertEqual(custom_filters.parse_date("02/01/2018", "%d/%m/%Y"), datetime.datetime(2018, 1, 2))
+        self.assertEqual(custom_filters.parse_date("2018-01-02T03:04:05+01:00", "True"),
+                         datetime.datetime(2018, 1, 2, 3, 4, 5))
+
+    def test_parse_date_cached(self):
+        with mock.patch('automationcommon.templatetags.custom_filters._parse_date',
+                        return_value=datetime.datetime(2018, 1, 2)) as parse_date:
+            custom_filters.parse_date("2018-01-02 cached")
+            self.assertEqual(custom_filters.parse_date("2018-01-02 cached"), datetime.datetime(2018, 1, 2))
+        parse_date.assert_called_once_with("2018-01-02 cached", False)
+
+    def test_parse_date_lru(self):
+        custom_filters._parsed_dates.clear()
+        with mock.patch('automationcommon.templatetags.custom_filters.MEMO_SIZE', 2), \
+                mock.patch('automationcommon.templatetags.custom_filters._parse_date',
+                           return_value=datetime.datetime(2018, 1, 2)) as parse_date:
+            custom_filters.parse_date("hot")
+            custom_filters.parse_date("cold")
+            custom_filters.parse_date("hot")
+            # evicts "cold" (the least recently used)
+            custom_filters.parse_date("new")
+            custom_filters.parse_date("hot")
+            custom_filters.parse_date("cold")
+        self.assertEqual([args[0] for args, kwargs in parse_date.call_args_list], ["hot", "cold", "new", "cold"])
+        custom_filters._parsed_dates.clear()
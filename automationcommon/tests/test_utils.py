@@ -1,10 +1,21 @@
+import datetime
+import io
+import json
+import re
 from collections import namedtuple
 
 from django.contrib.auth.models import User
-from django.test import TestCase
+from django.core import mail
+from django.core.cache import cache
+from django.template import Engine, Template, TemplateDoesNotExist
+from django.test import TestCase, override_settings
+from django.utils.timezone import get_fixed_timezone, utc
+import mock
 from mock import Mock, MagicMock
 
 import automationcommon.utils as utils
+from automationcommon.models import Audit
+from automationcommon.tests.models import Window
 
 
 class UtilsTests(TestCase):
@@ -18,6 +29,11 @@ class UtilsTests(TestCase):
         utils.createConnection = Mock(side_effect=create_connection_fake)
 
         self.PersonMethods_getPerson = utils.PersonMethods.getPerson
+        self.PersonMethods_listPeople = utils.PersonMethods.listPeople
+
+        cache.clear()
+        utils.lookup_pool.clear()
+        utils._email_templates.clear()
 
     def test_get_users_email_address_from_lookup(self):
 
@@ -39,7 +55,9 @@ class UtilsTests(TestCase):
 
         # setup user where lookup success
         user_found = User(username='fsf1000', last_name="F Scott Fitzgerald")
-        utils.PersonMethods.getPerson = MagicMock(return_value=Attributes(attributes=[Value(value="fsf1001@cam.ac.uk")]))
+        utils.PersonMethods.getPerson = MagicMock(
+            return_value=Attributes(attributes=[Value(value="fsf1001@cam.ac.uk")])
+        )
 
         # test for full address
         result = utils.get_users_email_address_from_lookup(user_found)
@@ -49,6 +67,471 @@ class UtilsTests(TestCase):
         result = utils.get_users_email_address_from_lookup(user_found, True)
         self.assertEqual(result, "fsf1001@cam.ac.uk")
 
+    def test_get_users_email_address_from_lookup_cached(self):
+
+        Attributes = namedtuple('Attributes', 'attributes')
+        Value = namedtuple('Value', 'value')
+
+        user_found = User(username='fsf1000', last_name="F Scott Fitzgerald")
+        user_none = User(username='jfk1000', last_name="John F Kennedy")
+        utils.PersonMethods.getPerson = MagicMock(
+            return_value=Attributes(attributes=[Value(value="fsf1001@cam.ac.uk")])
+        )
+
+        # test
+        utils.get_users_email_address_from_lookup(user_found)
+        result = utils.get_users_email_address_from_lookup(user_found, True)
+
+        # check
+        self.assertEqual(result, "fsf1001@cam.ac.uk")
+        self.assertEqual(utils.PersonMethods.getPerson.call_count, 1)
+
+        # test negative caching
+        utils.PersonMethods.getPerson = MagicMock(return_value=None)
+        utils.get_users_email_address_from_lookup(user_none)
+        result = utils.get_users_email_address_from_lookup(user_none, True)
+
+        # check
+        self.assertEqual(result, "jfk1000@cam.ac.uk")
+        self.assertEqual(utils.PersonMethods.getPerson.call_count, 1)
+
+    def test_lookup_email_addresses_mixed_case(self):
+
+        Attributes = namedtuple('Attributes', 'attributes')
+        Value = namedtuple('Value', 'value')
+
+        utils.PersonMethods.getPerson = MagicMock(return_value=Attributes(attributes=[Value(value="abc12@cam.ac.uk")]))
+
+        # test
+        result = utils.lookup_email_addresses(['ABC12'])
+
+        # check
+        self.assertEqual(result, {'ABC12': "abc12@cam.ac.uk"})
+        utils.PersonMethods.getPerson.assert_called_once_with(scheme="crsid", identifier='ABC12', fetch="email")
+
+    def test_get_users_email_addresses_from_lookup(self):
+
+        Person = namedtuple('Person', 'identifier attributes')
+        Value = namedtuple('Value', 'value')
+
+        users = [
+            User(username='fsf1000', last_name="F Scott Fitzgerald"),
+            User(username='jfk1000', last_name="John F Kennedy"),
+            User(username='abc1000'),
+        ]
+        utils.PersonMethods.getPerson = MagicMock()
+        utils.PersonMethods.listPeople = MagicMock(return_value=[
+            Person(identifier=Value(value='fsf1000'), attributes=[Value(value="fsf1001@cam.ac.uk")]),
+            Person(identifier=Value(value='jfk1000'), attributes=[]),
+        ])
+
+        # test
+        result = utils.get_users_email_addresses_from_lookup(users)
+
+        # check
+        self.assertEqual(result, [
+            "F Scott Fitzgerald <fsf1001@cam.ac.uk>", "John F Kennedy <jfk1000@cam.ac.uk>", "abc1000@cam.ac.uk"
+        ])
+        utils.PersonMethods.listPeople.assert_called_once_with('fsf1000,jfk1000,abc1000', fetch="email")
+        utils.PersonMethods.getPerson.assert_not_called()
+
+        # test that the results were cached
+        result = utils.get_users_email_addresses_from_lookup(users, True)
+
+        # check
+        self.assertEqual(result, ["fsf1001@cam.ac.uk", "jfk1000@cam.ac.uk", "abc1000@cam.ac.uk"])
+        self.assertEqual(utils.PersonMethods.listPeople.call_count, 1)
+
+    def test_lookup_connection(self):
+
+        # test
+        with utils.lookup_connection() as conn1:
+            pass
+        with utils.lookup_connection() as conn2:
+            with utils.lookup_connection() as conn3:
+                pass
+
+        # check
+        self.assertIs(conn1, conn2)
+        self.assertIsNot(conn2, conn3)
+        self.assertEqual(utils.createConnection.call_count, 2)
+
+        # test that the pool is emptied in a forked process
+        with mock.patch('automationcommon.utils.os.getpid', return_value=-1):
+            with utils.lookup_connection() as conn4:
+                pass
+
+        # check
+        self.assertIsNot(conn4, conn1)
+        self.assertIsNot(conn4, conn3)
+
+    def test_keep_alive_lookup_connection(self):
+
+        ibis_conn = Mock(host='www.lookup.cam.ac.uk', port=443, ca_certs=None, authorization='Basic x')
+        ibis_conn._params_to_strings = lambda params: params
+        ibis_conn._build_url = lambda path, path_params, query_params: path % path_params
+        response = Mock(status=200, reason='OK', will_close=False)
+        response.read.return_value = b'<result version="1.0"></result>'
+        response.getheader.return_value = 'application/xml'
+
+        with mock.patch('automationcommon.utils.HTTPSValidatingConnection') as https:
+            https.return_value.getresponse.return_value = response
+            conn = utils.KeepAliveLookupConnection(ibis_conn)
+
+            # test
+            conn.invoke_method('GET', '/api/v1/person/crsid/%(id)s', {'id': 'abc1'})
+            conn.invoke_method('GET', '/api/v1/person/crsid/%(id)s', {'id': 'abc2'})
+
+            # check that the HTTPS connection was reused
+            self.assertEqual(https.call_count, 1)
+            https.return_value.request.assert_called_with(
+                'GET', '/api/v1/person/crsid/abc2', None, {"Accept": "application/xml", "Authorization": 'Basic x'}
+            )
+
+            # test that a closed connection is retried with a new connection
+            https.return_value.getresponse.side_effect = [utils.HTTPException('closed'), response]
+            conn.invoke_method('GET', '/api/v1/person/crsid/%(id)s', {'id': 'abc3'})
+
+            # check
+            self.assertEqual(https.call_count, 2)
+
+    @override_settings(SERVER_EMAIL='noreply@example.com', SERVER_EMAIL_FULL='Example <noreply@example.com>')
+    def test_send_mass(self):
+
+        def get_template(name):
+            if name.endswith('.html'):
+                raise TemplateDoesNotExist(name)
+            return Mock(render=lambda context: 'Reminder\nHello %s' % context['name'])
+
+        utils.PersonMethods.getPerson = MagicMock(return_value=None)
+        utils.PersonMethods.listPeople = MagicMock(return_value=[])
+        user = User(username='jfk1000', last_name="John F Kennedy")
+
+        connection = mail.get_connection()
+        send_messages = connection.send_messages
+
+        def send_messages_failing(messages):
+            if messages[0].to == ['c@example.com']:
+                raise IOError('refused')
+            return send_messages(messages)
+
+        # test
+        with mock.patch('automationcommon.utils.get_template', side_effect=get_template), \
+                mock.patch('automationcommon.utils.get_connection', return_value=connection) as get_connection, \
+                mock.patch.object(connection, 'send_messages', side_effect=send_messages_failing):
+            sent, failed = utils.send_mass([
+                {'recipients': 'a@example.com', 'email_template': 'reminder', 'context': {'name': 'A'}},
+                {'recipients': 'c@example.com', 'email_template': 'reminder', 'context': {'name': 'C'}},
+                {'recipients': [user, 'b@example.com'], 'email_template': 'reminder', 'context': {'name': 'B'}},
+            ])
+
+        # check
+        self.assertEqual(get_connection.call_count, 1)
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual([message.to for message in sent],
+                         [['a@example.com'], ['John F Kennedy <jfk1000@cam.ac.uk>', 'b@example.com']])
+        self.assertEqual(sent[1].subject, 'Reminder')
+        self.assertEqual(sent[1].body, 'Hello B')
+        self.assertEqual(len(failed), 1)
+        self.assertEqual(failed[0][0].body, 'Hello C')
+        self.assertIsInstance(failed[0][1], IOError)
+        utils.PersonMethods.getPerson.assert_called_once_with(scheme="crsid", identifier='jfk1000', fetch="email")
+
+    @override_settings(SERVER_EMAIL='noreply@example.com', SERVER_EMAIL_FULL='Example <noreply@example.com>')
+    def test_send_mass_connection_refused(self):
+
+        template = Mock(render=lambda context: 'Reminder\nHello')
+        connection = Mock()
+        connection.open.side_effect = IOError('refused')
+
+        # test
+        with mock.patch('automationcommon.utils.get_email_templates', return_value=(template, None)), \
+                mock.patch('automationcommon.utils.get_connection', return_value=connection):
+            sent, failed = utils.send_mass([
+                {'recipients': 'a@example.com', 'email_template': 'reminder', 'context': {}},
+                {'recipients': 'b@example.com', 'email_template': 'reminder', 'context': {}},
+            ])
+
+        # check
+        self.assertEqual(sent, [])
+        self.assertEqual([message.to for message, e in failed], [['a@example.com'], ['b@example.com']])
+        self.assertTrue(all(isinstance(e, IOError) for message, e in failed))
+        self.assertFalse(connection.send_messages.called)
+
+    def test_envelopes(self):
+
+        with mock.patch('ucamlookup.signals.return_visibleName_by_crsid', return_value="John F Kennedy"):
+            user = User.objects.create(username='jfk1000')
+        attachment = Mock()
+        attachment.name = 'report.txt'
+        attachment.read.return_value = b'report'
+
+        # test
+        envelope = utils.make_envelope(
+            [user, 'b@example.com'], 'reminder', {'name': 'B'}, [attachment, ('data.csv', 'a,b', 'text/csv')],
+            cc=['c@example.com']
+        )
+        emails = utils.open_envelopes([json.loads(json.dumps(envelope))])
+
+        # check
+        self.assertEqual(envelope['recipients'], [{'user': user.pk}, 'b@example.com'])
+        self.assertEqual(emails, [{
+            'recipients': [user, 'b@example.com'], 'email_template': 'reminder', 'context': {'name': 'B'},
+            'attachments': [('report.txt', b'report', None), ('data.csv', b'a,b', 'text/csv')],
+            'reply_to': None, 'bcc': False, 'cc': ['c@example.com'],
+        }])
+
+    @override_settings(SERVER_EMAIL='noreply@example.com', SERVER_EMAIL_FULL='Example <noreply@example.com>',
+                       EMAIL_ASYNC_RETRY_DELAY=10)
+    def test_send_envelopes(self):
+
+        text_template = Mock(render=lambda context: 'Reminder\nHello %s' % context['name'])
+        connection = mail.get_connection()
+        send_messages = connection.send_messages
+
+        def send_messages_failing(messages):
+            if messages[0].to == ['c@example.com']:
+                raise IOError('refused')
+            return send_messages(messages)
+
+        envelopes = [
+            utils.make_envelope('a@example.com', 'reminder', {'name': 'A'}),
+            utils.make_envelope('c@example.com', 'reminder', {'name': 'C'}),
+        ]
+
+        # test
+        with mock.patch('automationcommon.utils.get_email_templates', return_value=(text_template, None)), \
+                mock.patch('automationcommon.utils.get_connection', return_value=connection), \
+                mock.patch.object(connection, 'send_messages', side_effect=send_messages_failing), \
+                mock.patch.object(utils.send_envelopes, 'retry', return_value=Exception('retry')) as retry:
+            with self.assertRaises(Exception):
+                utils.send_envelopes(envelopes)
+
+        # check that only the failed email is retried
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['a@example.com'])
+        self.assertEqual(retry.call_args[1]['args'], [envelopes[1:]])
+        self.assertEqual(retry.call_args[1]['countdown'], 10)
+        self.assertEqual(retry.call_args[1]['max_retries'], 5)
+
+    @override_settings(SERVER_EMAIL='noreply@example.com', SERVER_EMAIL_FULL='Example <noreply@example.com>')
+    def test_send_envelopes_connection_refused(self):
+
+        text_template = Mock(render=lambda context: 'Reminder\nHello')
+        connection = Mock()
+        connection.open.side_effect = IOError('refused')
+
+        envelopes = [
+            utils.make_envelope('a@example.com', 'reminder', {}),
+            utils.make_envelope('b@example.com', 'reminder', {}),
+        ]
+
+        # test
+        with mock.patch('automationcommon.utils.get_email_templates', return_value=(text_template, None)), \
+                mock.patch('automationcommon.utils.get_connection', return_value=connection), \
+                mock.patch.object(utils.send_envelopes, 'retry', return_value=Exception('retry')) as retry:
+            with self.assertRaises(Exception):
+                utils.send_envelopes(envelopes)
+
+        # check that all the emails are retried
+        self.assertEqual(retry.call_args[1]['args'], [envelopes])
+        self.assertIsInstance(retry.call_args[1]['exc'], IOError)
+
+    def test_send_async(self):
+
+        # test
+        with mock.patch.object(utils.send_envelopes, 'delay') as delay:
+            utils.send_async('a@example.com', 'reminder', {'name': 'A'})
+
+        # check
+        delay.assert_called_once_with([utils.make_envelope('a@example.com', 'reminder', {'name': 'A'})])
+
+        # test that the email is sent straight away if it can't be queued
+        attachment = io.BytesIO(b'PDFDATA' * 10)
+        attachment.name = 'report.pdf'
+        with mock.patch.object(utils.send_envelopes, 'delay', side_effect=IOError('no broker')), \
+                mock.patch('automationcommon.utils.send_mass') as send_mass:
+            utils.send_async('a@example.com', 'reminder', {'name': 'A'}, attachments=attachment)
+
+        # check
+        send_mass.assert_called_once_with([{
+            'recipients': ['a@example.com'], 'email_template': 'reminder', 'context': {'name': 'A'},
+            'attachments': [('report.pdf', b'PDFDATA' * 10, None)], 'reply_to': None, 'bcc': False,
+        }])
+
+    def test_attach_file(self):
+
+        content = bytes(bytearray(range(256))) * 1000
+        attachment = io.BytesIO(content)
+        attachment.name = 'report.pdf'
+        message = mail.EmailMultiAlternatives(body='Body', to=['a@example.com'])
+
+        # test
+        utils.attach_file(message, attachment)
+
+        # check
+        part = message.message().get_payload()[1]
+        self.assertEqual(part.get_content_type(), 'application/pdf')
+        self.assertEqual(part.get_filename(), 'report.pdf')
+        self.assertEqual(part.get_payload(decode=True), content)
+        self.assertTrue(all(len(line) <= 76 for line in part.get_payload().splitlines()))
+
+    @override_settings(EMAIL_ATTACHMENT_MAX_SIZE=100, EMAIL_ATTACHMENT_BASE_URL='https://example.com/media/')
+    def test_attach_file_too_large(self):
+
+        attachment = Mock(size=101, url='reports/report.pdf')
+        attachment.name = 'report.pdf'
+        message = mail.EmailMultiAlternatives(body='Body', to=['a@example.com'])
+        message.attach_alternative('<html><body><p>Body</p></body></html>', 'text/html')
+
+        # test
+        utils.attach_file(message, attachment)
+
+        # check
+        attachment.read.assert_not_called()
+        self.assertEqual(message.attachments, [])
+        self.assertIn('download it from https://example.com/media/reports/report.pdf', message.body)
+        self.assertIn('<a href="https://example.com/media/reports/report.pdf">download it</a></p></body>',
+                      message.alternatives[0][0])
+
+    @override_settings(EMAIL_ATTACHMENT_MAX_SIZE=100)
+    def test_envelope_linked_attachment(self):
+
+        attachment = Mock(size=101, url='https://example.com/media/report.pdf')
+        attachment.name = 'report.pdf'
+
+        # test
+        envelope = utils.make_envelope('a@example.com', 'reminder', {}, attachment)
+        emails = utils.open_envelopes([envelope])
+
+        # check
+        attachment.read.assert_not_called()
+        self.assertEqual(emails[0]['attachments'],
+                         [utils.LinkedAttachment('report.pdf', 101, 'https://example.com/media/report.pdf')])
+
+        # test that the link is added on a worker without EMAIL_ATTACHMENT_MAX_SIZE
+        text_template = Mock(render=lambda context: 'Reminder\nHello')
+        with self.settings(EMAIL_ATTACHMENT_MAX_SIZE=None, SERVER_EMAIL='noreply@example.com',
+                           SERVER_EMAIL_FULL='Example <noreply@example.com>'), \
+                mock.patch('automationcommon.utils.get_email_templates', return_value=(text_template, None)):
+            [(message, email)] = utils.build_messages(emails)
+
+        # check
+        self.assertEqual(message.attachments, [])
+        self.assertIn('download it from https://example.com/media/report.pdf', message.body)
+
+    def test_get_email_templates(self):
+
+        text_template = Mock(render=lambda context: 'Subject\nBody')
+
+        def get_template(name):
+            if name.endswith('.html'):
+                raise TemplateDoesNotExist(name)
+            return text_template
+
+        # test
+        with mock.patch('automationcommon.utils.get_template', side_effect=get_template) as mock_get_template:
+            utils.get_email_templates('reminder')
+            templates = utils.get_email_templates('reminder')
+
+        # check that the templates (and the missing html template) were cached
+        self.assertEqual(templates, (text_template, None))
+        self.assertEqual(mock_get_template.call_count, 2)
+
+    def test_render_template(self):
+
+        # test a legacy template
+        self.assertEqual(utils.render_template(Template('Hello {{ name }}', engine=Engine()), {'name': 'A'}), 'Hello A')
+
+        # test an engine template
+        template = Mock()
+        utils.render_template(template, {'name': 'A'})
+        template.render.assert_called_once_with({'name': 'A'})
+
+    def test_json_date_parser(self):
+
+        # test
+        result = json.loads(
+            '[{"START_DATE": "2018-01-02T03:04:05", "NAME": "2018-01-02T03:04:05"},'
+            ' {"START_DATE": "2018-01-02T03:04:05.123456+01:00", "END_DATE": "2018-01-02T03:04:05Z"},'
+            ' {"START_DATE": "2018-01-02", "END_DATE": "tomorrow", "DATES": 3}]',
+            object_hook=utils.json_date_parser
+        )
+
+        # check
+        self.assertEqual(result[0], {
+            'START_DATE': datetime.datetime(2018, 1, 2, 3, 4, 5), 'NAME': "2018-01-02T03:04:05"
+        })
+        self.assertEqual(result[1]['START_DATE'], datetime.datetime(
+            2018, 1, 2, 3, 4, 5, 123456, tzinfo=get_fixed_timezone(60)
+        ))
+        self.assertEqual(result[1]['END_DATE'], datetime.datetime(2018, 1, 2, 3, 4, 5, tzinfo=utc))
+        self.assertEqual(result[2], {'START_DATE': "2018-01-02", 'END_DATE': "tomorrow", 'DATES': 3})
+
+    def test_make_json_date_parser(self):
+
+        # test
+        result = json.loads(
+            '{"created": "2018-01-02T03:04:05", "updated_at": "2018-01-02T03:04:05",'
+            ' "START_DATE": "2018-01-02T03:04:05"}',
+            object_hook=utils.make_json_date_parser(re.compile('^created$|_at$'))
+        )
+
+        # check
+        self.assertEqual(result, {
+            'created': datetime.datetime(2018, 1, 2, 3, 4, 5), 'updated_at': datetime.datetime(2018, 1, 2, 3, 4, 5),
+            'START_DATE': "2018-01-02T03:04:05"
+        })
+
+    def test_iter_json_array(self):
+
+        objects = [{'DATE': datetime.datetime(2018, 1, 2, 3, 4, 5), 'n': n} for n in range(5)]
+
+        # test
+        chunks = list(utils.iter_json_array(iter(objects), chunk_size=2))
+
+        # check
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(json.loads(''.join(chunks), object_hook=utils.json_date_parser), objects)
+        self.assertEqual(list(utils.iter_json_array([])), ['[]'])
+
+    def test_json_lines(self):
+
+        objects = [{'DATE': datetime.datetime(2018, 1, 2, 3, 4, 5), 'n': n} for n in range(5)]
+
+        # test
+        chunks = list(utils.iter_json_lines(iter(objects), chunk_size=2))
+        lines = io.BytesIO(''.join(chunks).encode('utf-8'))
+
+        # check
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(list(utils.read_json_lines(lines)), objects)
+
+    def test_streaming_json_response(self):
+
+        # test
+        response = utils.streaming_json_response(iter([{'n': 1}, {'n': 2}]), lines=True)
+
+        # check
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(b''.join(response.streaming_content), b'{"n": 1}\n{"n": 2}\n')
+
+    def test_prefetch_users(self):
+
+        with mock.patch('ucamlookup.signals.return_visibleName_by_crsid', return_value="John F Kennedy"):
+            owners = [User.objects.create(username='jfk1000'), User.objects.create(username='fsf1000')]
+        for n in range(4):
+            Window.objects.create(name='window%d' % n, owner=owners[n % 2] if n < 3 else None)
+
+        # test
+        with self.assertNumQueries(2):
+            windows = utils.prefetch_users(Window.objects.order_by('name'), 'owner')
+            owners = [window.owner for window in windows]
+
+        # check
+        self.assertEqual([owner.username if owner else None for owner in owners],
+                         ['jfk1000', 'fsf1000', 'jfk1000', None])
+
     def test_paginate(self):
         Request = namedtuple('Request', 'GET')
         object_list = [1, 2, 3, 4, 5, 6, 7]
@@ -63,6 +546,48 @@ class UtilsTests(TestCase):
         paginator = utils.paginate(Request(GET={"page": 4}), object_list, 3)
         self.assertEqual(paginator[0], 7)
 
+    def test_paginate_cursor(self):
+        Request = namedtuple('Request', 'GET')
+        now = datetime.datetime.now()
+        Audit.objects.bulk_create([
+            Audit(when=now - datetime.timedelta(minutes=i // 2), model='Window', model_pk=str(i), field='name')
+            for i in range(7)
+        ])
+        expected = [audit.model_pk for audit in Audit.objects.order_by('-when', '-id')]
+
+        # 1st page (without a count)
+        with self.assertNumQueries(1):
+            page = utils.paginate_cursor(Request(GET={}), Audit.objects.all(), ['-when'], 3)
+        self.assertEqual(expected[0:3], [audit.model_pk for audit in page])
+        self.assertFalse(page.has_previous())
+        self.assertTrue(page.has_next())
+        self.assertIsNone(page.estimated_count)
+
+        # 2nd page
+        page = utils.paginate_cursor(Request(GET={'cursor': page.next_cursor}), Audit.objects.all(), ['-when'], 3)
+        self.assertEqual(expected[3:6], [audit.model_pk for audit in page])
+        self.assertTrue(page.has_previous())
+        self.assertTrue(page.has_next())
+
+        # last page
+        last = utils.paginate_cursor(Request(GET={'cursor': page.next_cursor}), Audit.objects.all(), ['-when'], 3)
+        self.assertEqual(expected[6:], [audit.model_pk for audit in last])
+        self.assertFalse(last.has_next())
+
+        # back to the 2nd page
+        page = utils.paginate_cursor(Request(GET={'cursor': last.previous_cursor}), Audit.objects.all(), ['-when'], 3)
+        self.assertEqual(expected[3:6], [audit.model_pk for audit in page])
+
+        # back to the 1st page
+        page = utils.paginate_cursor(Request(GET={'cursor': page.previous_cursor}), Audit.objects.all(), ['-when'], 3)
+        self.assertEqual(expected[0:3], [audit.model_pk for audit in page])
+        self.assertFalse(page.has_previous())
+
+        # invalid cursor (1st page)
+        page = utils.paginate_cursor(Request(GET={'cursor': 'rubbish'}), Audit.objects.all(), ['-when'], 3)
+        self.assertEqual(expected[0:3], [audit.model_pk for audit in page])
+
     def tearDown(self):
         utils.createConnection = self.createConnection
         utils.PersonMethods.getPerson = self.PersonMethods_getPerson
+        utils.PersonMethods.listPeople = self.PersonMethods_listPeople
@@ -6,6 +6,7 @@ from automationcommon import views as common
 urlpatterns = [
     # service status page
     url(r'^status/20d47308-dd08-4aa6-991c-c46a6e7fced7/$', common.status, name='status-page'),
+    url(r'^status/20d47308-dd08-4aa6-991c-c46a6e7fced7/metrics/$', common.status_metrics, name='status-metrics'),
 ]
 
 
@@ -1,21 +1,54 @@
+import base64
+import binascii
 import datetime
+import json
 import logging
+import mimetypes
+import os
 import re
+import socket
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from email.mime.base import MIMEBase
 from celery import Task
 from celery import shared_task
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
-from django.core.mail import EmailMultiAlternatives
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.mail import EmailMultiAlternatives, get_connection
 from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
-from django.http import HttpResponse
-from django.template import Context
+from django.db import connections
+from django.db.models import Q
+from django.http import HttpResponse, StreamingHttpResponse
+from django.template import Context, Template
 from django.template import TemplateDoesNotExist
 from django.template.loader import get_template
+from django.utils.dateparse import parse_datetime
 from django.utils.decorators import method_decorator
+from django.utils import six
+from django.utils.html import escape
 from django.views.generic import TemplateView
 from stronghold.decorators import public
 from ucamlookup import createConnection, PersonMethods
+from ucamlookup.ibisclient.connection import HTTPSValidatingConnection
+from ucamlookup.ibisclient.dto import IbisError, IbisResult, IbisResultParser
+
+try:
+    import queue
+    from http.client import HTTPException
+    from urllib.parse import urlencode, urljoin
+except ImportError:
+    import Queue as queue
+    from httplib import HTTPException
+    from urllib import urlencode
+    from urlparse import urljoin
+
+from automationcommon import health
+from automationcommon.models import Audit
 
 
 LOGGER = logging.getLogger('automationcommon')
@@ -28,6 +61,161 @@ class ApplicationError(Exception):
     pass
 
 
+class KeepAliveLookupConnection(object):
+    """
+    Wraps a lookup connection (from createConnection()) so that the HTTPS connection to lookup (and its TLS session)
+    is kept alive and reused by successive API calls rather than a new one being made for each call. An instance
+    must only be used by one thread at a time (see LookupConnectionPool).
+    """
+
+    def __init__(self, conn):
+        """
+        :param conn: the IbisClientConnection to wrap
+        """
+        self.conn = conn
+        self.https = None
+        self.last_used = None
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def close(self):
+        """
+        Closes the HTTPS connection (a new one is made by the next call).
+        """
+        if self.https is not None:
+            self.https.close()
+            self.https = None
+
+    def invoke_method(self, method, path, path_params={}, query_params={}, form_params={}):
+        """
+        Invokes a lookup API method as IbisClientConnection.invoke_method() does but over the kept alive HTTPS
+        connection. If a reused connection turns out to have been closed by lookup then the call is retried once
+        with a new connection.
+        """
+        url = self.conn._build_url(
+            path, self.conn._params_to_strings(path_params), self.conn._params_to_strings(query_params)
+        )
+        form_params = self.conn._params_to_strings(form_params)
+        headers = {"Accept": "application/xml", "Authorization": self.conn.authorization}
+        body = None
+        if form_params:
+            body = urlencode(form_params)
+            headers["Content-type"] = "application/x-www-form-urlencoded"
+
+        reused = self.https is not None
+        try:
+            response = self._request(method, url, body, headers)
+        except (HTTPException, socket.error):
+            self.close()
+            if not reused:
+                raise
+            response = self._request(method, url, body, headers)
+
+        content = response.read()
+        self.last_used = time.time()
+        if response.will_close:
+            self.close()
+
+        if response.getheader("Content-type") != "application/xml":
+            error = IbisError({"status": response.status, "code": response.reason})
+            error.message = "Unexpected result from server"
+            error.details = content
+            result = IbisResult()
+            result.error = error
+            return result
+
+        return IbisResultParser().parse_xml(content)
+
+    def _request(self, method, url, body, headers):
+        if self.https is None:
+            self.https = HTTPSValidatingConnection(self.conn.host, self.conn.port, self.conn.ca_certs)
+        self.https.request(method, url, body, headers)
+        return self.https.getresponse()
+
+
+class LookupConnectionPool(object):
+    """
+    A thread safe pool of (up to LOOKUP_POOL_SIZE, default 4) KeepAliveLookupConnections. Connections that have been
+    idle for longer than LOOKUP_POOL_IDLE_TIMEOUT seconds (default 30) are reconnected before they're used (as lookup
+    will probably have closed them). The pool is emptied if the process has forked (so that a pre-fork worker doesn't
+    share its parent's connections).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = None
+        self.connections = None
+
+    def _get_connections(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                self.connections = queue.LifoQueue(getattr(settings, 'LOOKUP_POOL_SIZE', 4))
+                self.pid = os.getpid()
+            return self.connections
+
+    def acquire(self):
+        """
+        :return: a pooled (or new) connection
+        """
+        try:
+            conn = self._get_connections().get_nowait()
+        except queue.Empty:
+            return KeepAliveLookupConnection(createConnection())
+        if conn.last_used is not None and \
+                time.time() - conn.last_used > getattr(settings, 'LOOKUP_POOL_IDLE_TIMEOUT', 30):
+            conn.close()
+        return conn
+
+    def release(self, conn):
+        """
+        Returns a connection to the pool (or closes it if the pool is full).
+
+        :param conn: a connection from acquire()
+        """
+        try:
+            self._get_connections().put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def clear(self):
+        """
+        Closes and removes all the pooled connections.
+        """
+        connections = self._get_connections()
+        while True:
+            try:
+                connections.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+# the pool of connections used by all the lookup calls
+lookup_pool = LookupConnectionPool()
+
+
+@contextmanager
+def lookup_connection():
+    """
+    A context manager that borrows a connection to lookup from the pool.
+
+    Usage: with lookup_connection() as conn: PersonMethods(conn).getPerson(...)
+    """
+    conn = lookup_pool.acquire()
+    try:
+        yield conn
+    except Exception:
+        # the connection may be in an unknown state
+        conn.close()
+        raise
+    finally:
+        lookup_pool.release(conn)
+
+
+# The prefix of the cache keys of looked up email addresses
+EMAIL_CACHE_KEY_PREFIX = 'automationcommon:email:'
+
+
 def get_users_email_address_from_lookup(user, email_only=False):
     """
     This function look's up an email address for a user. If one cannot be found it returns a default
@@ -37,23 +225,99 @@ def get_users_email_address_from_lookup(user, email_only=False):
     :param email_only: True = '{email}' False = '{name} <{email}>'
     :return: looked up user email of default
     """
-    conn = createConnection()
-    result = PersonMethods(conn).getPerson(scheme="crsid", identifier=user.username, fetch="email")
-    if user.get_full_name() and not email_only:
-        default = "%s <%s@cam.ac.uk>" % (user.get_full_name(), user.username)
-    else:
-        default = "%s@cam.ac.uk" % user.username
+    return get_users_email_addresses_from_lookup([user], email_only)[0]
+
+
+def get_users_email_addresses_from_lookup(users, email_only=False):
+    """
+    Looks up the email addresses of a list of users (with a single lookup call for any that aren't cached - see
+    lookup_email_addresses()). If one cannot be found then a default of crsid@cam.ac.uk is used.
+
+    :param users: a list of django users
+    :param email_only: True = '{email}' False = '{name} <{email}>'
+    :return: the list of looked up (or default) user emails in the same order as users
+    """
+    emails = lookup_email_addresses([user.username for user in users])
+    addresses = []
+    for user in users:
+        email = emails[user.username] or "%s@cam.ac.uk" % user.username
+        if user.get_full_name() and not email_only:
+            addresses.append("%s <%s>" % (user.get_full_name(), email))
+        else:
+            addresses.append(email)
+    return addresses
+
+
+def lookup_email_addresses(crsids):
+    """
+    Looks up the email addresses of a list of crsids. Cached addresses are kept for EMAIL_LOOKUP_CACHE_TTL seconds
+    (default an hour) and crsids without an address for EMAIL_LOOKUP_NEGATIVE_CACHE_TTL seconds (default 5 minutes).
+    The crsids that aren't cached are looked up with one listPeople call per EMAIL_LOOKUP_BATCH_SIZE (default 100)
+    crsids (or one getPerson call if there is only one).
+
+    :param crsids: a list of crsids
+    :return: a dict of email addresses (or None if one couldn't be found) keyed by crsid
+    """
+    cached = cache.get_many([EMAIL_CACHE_KEY_PREFIX + crsid for crsid in crsids])
+    emails = {}
+    missing = []
+    for crsid in crsids:
+        email = cached.get(EMAIL_CACHE_KEY_PREFIX + crsid)
+        if email is None:
+            if crsid not in missing:
+                missing.append(crsid)
+        else:
+            # '' is cached for crsids without an address
+            emails[crsid] = email or None
+    if not missing:
+        return emails
+
+    with lookup_connection() as conn:
+        if len(missing) == 1:
+            results = {
+                missing[0].lower(): PersonMethods(conn).getPerson(scheme="crsid", identifier=missing[0], fetch="email")
+            }
+        else:
+            results = {}
+            batch_size = getattr(settings, 'EMAIL_LOOKUP_BATCH_SIZE', 100)
+            for start in range(0, len(missing), batch_size):
+                people = PersonMethods(conn).listPeople(",".join(missing[start:start + batch_size]), fetch="email")
+                for person in people:
+                    results[person.identifier.value.lower()] = person
+
+    found = {}
+    not_found = {}
+    for crsid in missing:
+        email = _get_email_from_lookup_result(crsid, results.get(crsid.lower()))
+        emails[crsid] = email
+        if email:
+            found[EMAIL_CACHE_KEY_PREFIX + crsid] = email
+        else:
+            not_found[EMAIL_CACHE_KEY_PREFIX + crsid] = ''
+    if found:
+        cache.set_many(found, getattr(settings, 'EMAIL_LOOKUP_CACHE_TTL', 3600))
+    if not_found:
+        cache.set_many(not_found, getattr(settings, 'EMAIL_LOOKUP_NEGATIVE_CACHE_TTL', 300))
+    return emails
+
+
+def _get_email_from_lookup_result(crsid, result):
+    """
+    :param crsid: the crsid that was looked up
+    :param result: the person returned by lookup (or None)
+    :return: the person's email address or None if they don't have a valid one
+    """
     if result is None:
-        LOGGER.info("no results returned from email lookup - defaulting to '%s'" % default)
-        return default
+        LOGGER.info("no results returned from email lookup for '%s' - using the default" % crsid)
+        return None
     if result.attributes is None or len(result.attributes) == 0:
-        LOGGER.warning("no attributes returned from email lookup - defaulting to '%s'" % default)
-        return default
+        LOGGER.warning("no attributes returned from email lookup for '%s' - using the default" % crsid)
+        return None
     if '@' not in result.attributes[0].value:
-        LOGGER.warning("'%s' is not an email address - defaulting to '%s'" % (result.attributes[0].value, default))
-        return default
-    if user.get_full_name() and not email_only:
-        return "%s <%s>" % (user.get_full_name(), result.attributes[0].value)
+        LOGGER.warning(
+            "'%s' is not an email address - using the default for '%s'" % (result.attributes[0].value, crsid)
+        )
+        return None
     return result.attributes[0].value
 
 
@@ -101,6 +365,148 @@ def test_celery_email():
     raise Exception("This is test for a Celery Exception")
 
 
+@shared_task(base=TaskWithFailure)
+def write_audit_records(records):
+    """
+    Writes the audit records queued when AUDIT_ASYNC is set, in batches of AUDIT_ASYNC_BATCH_SIZE (default 500).
+
+    :param records: list of audit records (see Audit.to_record())
+    """
+    Audit.objects.bulk_create(
+        [Audit.from_record(record) for record in records],
+        batch_size=getattr(settings, 'AUDIT_ASYNC_BATCH_SIZE', 500)
+    )
+
+
+@shared_task(base=TaskWithFailure)
+def refresh_status_snapshot():
+    """
+    Refreshes the status page's snapshot of the service checks. Schedule this with celery beat every
+    SERVICE_CHECK_INTERVAL seconds when SERVICE_CHECK_REFRESHER is 'celery'.
+    """
+    health.refresh_status()
+
+
+def send_async(recipients, email_template, context, attachments=None, reply_to=None, bcc=False, **kwargs):
+    """
+    Queues an email to be sent by a celery worker (see send() for the parameters). The context and any other kwargs
+    must be serialisable by celery. If the email can't be queued then it is sent straight away.
+    """
+    send_mass_async([dict(
+        kwargs, recipients=recipients, email_template=email_template, context=context, attachments=attachments,
+        reply_to=reply_to, bcc=bcc
+    )])
+
+
+def send_mass_async(emails):
+    """
+    Queues a batch of emails to be sent by a celery worker over a single connection to the mail server (see
+    send_mass() for the parameters). If the emails can't be queued then they are sent straight away.
+    """
+    envelopes = [make_envelope(**email) for email in emails]
+    try:
+        send_envelopes.delay(envelopes)
+    except Exception as e:
+        LOGGER.warning("Couldn't queue %d emails (%s) - sending them now" % (len(envelopes), e))
+        # the envelopes are used as any attachments have already been read
+        send_mass(open_envelopes(envelopes))
+
+
+def make_envelope(recipients, email_template, context, attachments=None, reply_to=None, bcc=False, **kwargs):
+    """
+    Converts send() arguments into a serialisable envelope - users are replaced by their ids and attachments by their
+    base64 encoded contents.
+
+    :return: the envelope dict
+    """
+    if isinstance(recipients, str) or isinstance(recipients, User):
+        recipients = [recipients]
+    if attachments and attachments.__class__ != list:
+        attachments = [attachments]
+
+    max_size = getattr(settings, 'EMAIL_ATTACHMENT_MAX_SIZE', None)
+    encoded = []
+    for attachment in attachments or []:
+        if attachment.__class__ == tuple:
+            filename, content, mimetype = attachment
+        elif max_size is not None and getattr(attachment, 'url', None) and \
+                (_get_file_size(attachment) or 0) > max_size:
+            # the file will be linked to (see attach_file()) so isn't read
+            encoded.append({'name': attachment.name, 'size': _get_file_size(attachment), 'url': attachment.url})
+            continue
+        else:
+            filename, content, mimetype = attachment.name, attachment.read(), None
+        if not isinstance(content, bytes):
+            content = content.encode('utf-8')
+        encoded.append([filename, base64.b64encode(content).decode('ascii'), mimetype])
+
+    return dict(
+        kwargs,
+        recipients=[recipient if isinstance(recipient, str) else {'user': recipient.pk} for recipient in recipients],
+        email_template=email_template, context=context, attachments=encoded, reply_to=reply_to, bcc=bcc
+    )
+
+
+# An attachment in an envelope that is too big to attach (see attach_file())
+LinkedAttachment = namedtuple('LinkedAttachment', 'name size url')
+
+
+def open_envelopes(envelopes):
+    """
+    Converts envelopes (see make_envelope()) back into send() arguments. Recipients that are users that no longer exist
+    are dropped.
+
+    :param envelopes: a list of envelopes
+    :return: a list of dicts of send() arguments
+    """
+    users = User.objects.in_bulk(set(
+        recipient['user'] for envelope in envelopes for recipient in envelope['recipients']
+        if isinstance(recipient, dict)
+    ))
+    emails = []
+    for envelope in envelopes:
+        recipients = []
+        for recipient in envelope['recipients']:
+            if not isinstance(recipient, dict):
+                recipients.append(recipient)
+            elif recipient['user'] in users:
+                recipients.append(users[recipient['user']])
+            else:
+                LOGGER.warning("email recipient user %s no longer exists" % recipient['user'])
+        attachments = []
+        for attachment in envelope['attachments']:
+            if isinstance(attachment, dict):
+                attachments.append(LinkedAttachment(**attachment))
+            else:
+                filename, content, mimetype = attachment
+                attachments.append((filename, base64.b64decode(content), mimetype))
+        emails.append(dict(envelope, recipients=recipients, attachments=attachments))
+    return emails
+
+
+@shared_task(base=TaskWithFailure, bind=True)
+def send_envelopes(self, envelopes):
+    """
+    Sends queued emails (see send_mass_async()) over a single connection to the mail server. Emails that fail are
+    retried up to EMAIL_ASYNC_MAX_RETRIES times (default 5) with an exponential backoff starting at
+    EMAIL_ASYNC_RETRY_DELAY seconds (default 60).
+
+    :param envelopes: a list of envelopes (see make_envelope())
+    """
+    messages = build_messages(open_envelopes(envelopes))
+    sent, failed = deliver_messages(messages)
+    # messages without any recipients aren't retried
+    failed = dict((id(message), e) for message, e in failed if e is not None)
+    if failed:
+        retry = [envelope for envelope, (message, email) in zip(envelopes, messages) if id(message) in failed]
+        raise self.retry(
+            args=[retry],
+            exc=list(failed.values())[0],
+            countdown=getattr(settings, 'EMAIL_ASYNC_RETRY_DELAY', 60) * 2 ** self.request.retries,
+            max_retries=getattr(settings, 'EMAIL_ASYNC_MAX_RETRIES', 5),
+        )
+
+
 def simple_authorization(func):
     """
     Decorator to test an HTTP request for an authorization header with a matching .
@@ -142,6 +548,188 @@ def paginate(request, object_list, per_page=25):
         return paginator.page(paginator.num_pages)
 
 
+def prefetch_users(object_list, *fields):
+    """
+    Fetches the users referenced by foreign keys of a list of objects (e.g. a page's object_list) with one query and
+    sets them on the objects, so that rendering them (e.g. with the display_user filter) doesn't query each one.
+
+    Usage: prefetch_users(page.object_list, 'owner', 'modified_by')
+
+    :param object_list: a list (or queryset) of model instances
+    :param fields: the names of the foreign keys (to the user model)
+    :return: the list of objects
+    """
+    objects = list(object_list)
+    # the pks referenced by the objects keyed by the model they reference
+    pks = {}
+    for obj in objects:
+        for field in fields:
+            model_field = obj._meta.get_field(field)
+            pk = getattr(obj, model_field.attname)
+            if pk is not None:
+                pks.setdefault(model_field.related_model, set()).add(pk)
+    users = dict((model, model._default_manager.in_bulk(model_pks)) for model, model_pks in pks.items())
+    for obj in objects:
+        for field in fields:
+            model_field = obj._meta.get_field(field)
+            user = users.get(model_field.related_model, {}).get(getattr(obj, model_field.attname))
+            if user is not None:
+                setattr(obj, field, user)
+    return objects
+
+
+class CursorPage(object):
+    """
+    A page returned by paginate_cursor(). It can be used much like django's Page except that there are no page
+    numbers or counts: link to the next/previous pages with the next_cursor/previous_cursor tokens as the "cursor"
+    request parameter.
+
+    Attributes:
+        object_list      the objects in the page
+        next_cursor      token for the next page (None if this is the last page)
+        previous_cursor  token for the previous page (None if this is the first page)
+        estimated_count  the planner's estimate of the total number of objects (None if not requested/available)
+    """
+    def __init__(self, object_list, next_cursor, previous_cursor, estimated_count=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        self.estimated_count = estimated_count
+
+    def __repr__(self):
+        return '<CursorPage of %d objects>' % len(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+def _encode_cursor(forward, values):
+    """
+    :return: an opaque token for a position in a cursor paginated queryset
+    """
+    token = json.dumps([forward, values], default=json_date_formatter, separators=(',', ':'))
+    return base64.urlsafe_b64encode(token.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def _decode_cursor(cursor, fields):
+    """
+    :return: (forward, values) decoded from a token created by _encode_cursor() or None if the token isn't valid
+    """
+    try:
+        forward, values = json.loads(
+            base64.urlsafe_b64decode(str(cursor) + '=' * (-len(cursor) % 4)).decode('utf-8')
+        )
+        if len(values) != len(fields):
+            return None
+        return bool(forward), [field.to_python(value) for field, value in zip(fields, values)]
+    except (ValueError, TypeError, binascii.Error, ValidationError):
+        return None
+
+
+def estimate_count(queryset):
+    """
+    :param queryset: a queryset
+    :return: the PostgreSQL planner's estimate of the number of rows the queryset returns (or None for other
+             databases) - this is much cheaper than counting the rows of a large table
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+    if not isinstance(plan, list):
+        plan = json.loads(plan)
+    return plan[0]['Plan']['Plan Rows']
+
+
+def paginate_cursor(request, queryset, ordering, per_page=25, estimated_count=False):
+    """
+    A keyset/cursor based alternative to paginate() for large querysets - assumes a request parameter of "cursor".
+    Each page is selected with a WHERE on the ordering fields rather than an OFFSET and no COUNT query is made.
+    The ordering should be supported by an index and the values of the ordering fields must not be null.
+
+    :param request: http request
+    :param queryset: queryset to select page from
+    :param ordering: list of field names to order by (as for order_by()) - the pk is added if it isn't included
+    :param per_page: the number of objects per page
+    :param estimated_count: if True then set the page's estimated_count (see estimate_count())
+    :return: CursorPage
+    """
+    # NOTE: an internal attribute has been used when introspecting the model.
+    meta = queryset.model._meta
+    ordering = list(ordering)
+    names = [name.lstrip('-') for name in ordering]
+    if 'pk' not in names and meta.pk.name not in names:
+        ordering.append('-pk' if ordering and ordering[-1].startswith('-') else 'pk')
+        names.append('pk')
+    fields = [meta.pk if name == 'pk' else meta.get_field(name) for name in names]
+    descending = [name.startswith('-') for name in ordering]
+
+    cursor = request.GET.get('cursor')
+    position = _decode_cursor(cursor, fields) if cursor else None
+    forward = position is None or position[0]
+
+    if forward:
+        page_queryset = queryset.order_by(*ordering)
+    else:
+        page_queryset = queryset.order_by(*[
+            name[1:] if desc else '-' + name for name, desc in zip(ordering, descending)
+        ])
+
+    if position is not None:
+        # (a, b) > (x, y) is a > x OR (a = x AND b > y) - the comparison flips for descending/backward fields
+        after = Q()
+        for index, (name, desc, value) in enumerate(zip(names, descending, position[1])):
+            condition = Q(**{'%s__%s' % (name, 'lt' if desc == forward else 'gt'): value})
+            for prev_name, prev_value in zip(names[:index], position[1][:index]):
+                condition &= Q(**{prev_name: prev_value})
+            after |= condition
+        page_queryset = page_queryset.filter(after)
+
+    object_list = list(page_queryset[:per_page + 1])
+    more = len(object_list) > per_page
+    object_list = object_list[:per_page]
+    if not forward:
+        object_list.reverse()
+
+    def values(obj):
+        return [getattr(obj, field.attname) for field in fields]
+
+    if object_list:
+        has_next = more if forward else True
+        has_previous = position is not None if forward else more
+        next_cursor = _encode_cursor(True, values(object_list[-1])) if has_next else None
+        previous_cursor = _encode_cursor(False, values(object_list[0])) if has_previous else None
+    elif position is not None:
+        # the objects around the cursor have gone so just link back to where it was
+        next_cursor = None if forward else _encode_cursor(True, position[1])
+        previous_cursor = _encode_cursor(False, position[1]) if forward else None
+    else:
+        next_cursor = previous_cursor = None
+
+    return CursorPage(
+        object_list, next_cursor, previous_cursor,
+        estimate_count(queryset) if estimated_count else None
+    )
+
+
 def send(recipients, email_template, context, attachments=None, reply_to=None, bcc=False, **kwargs):
     """
     Sends an email. By convention the first line of the template is assumed to be the subject.
@@ -156,16 +744,108 @@ def send(recipients, email_template, context, attachments=None, reply_to=None, b
 
     :return: the sent EmailMessage
     """
-    template = get_template('email/' + email_template + '.txt')
+    message = build_message(recipients, email_template, context, attachments, reply_to, bcc, **kwargs)
+
+    message.send()
+    LOGGER.info("email sent: to='%s' template='%s' context=%s" % (message.to, email_template, context))
+
+    return message
+
+
+def send_mass(emails):
+    """
+    Sends a batch of emails over a single connection to the mail server.
+
+    Usage: sent, failed = send_mass([
+        {'recipients': user, 'email_template': 'reminder', 'context': {'user': user}} for user in users
+    ])
+
+    :param emails: a list of dicts of send() arguments - one for each email
+    :return: a (sent, failed) tuple where sent is the list of sent EmailMessages and failed is a list of
+             (EmailMessage, exception) tuples (the exception is None if the message had no recipients)
+    """
+    return deliver_messages(build_messages(emails))
+
+
+def build_messages(emails):
+    """
+    Renders a batch of emails, looking up all the users' addresses together.
+
+    :param emails: a list of dicts of send() arguments - one for each email
+    :return: a list of (EmailMessage, send() arguments) tuples in the same order as emails
+    """
+    # look up all the users' addresses together (the results are cached for build_message())
+    users = set()
+    for email in emails:
+        recipients = email['recipients']
+        if isinstance(recipients, str) or isinstance(recipients, User):
+            recipients = [recipients]
+        users.update(recipient.username for recipient in recipients if not isinstance(recipient, str))
+    if users:
+        lookup_email_addresses(sorted(users))
+
+    return [(build_message(**email), email) for email in emails]
+
+
+def deliver_messages(messages):
+    """
+    Sends a batch of rendered emails over a single connection to the mail server.
+
+    :param messages: a list of (EmailMessage, send() arguments) tuples (see build_messages())
+    :return: a (sent, failed) tuple (see send_mass())
+    """
+    sent = []
+    failed = []
+    connection = get_connection()
+    try:
+        connection.open()
+    except Exception as e:
+        LOGGER.error("couldn't connect to the mail server: %s" % e)
+        return sent, [(message, e) for message, email in messages]
     try:
-        subject_and_body = template.render(Context(context)).split('\n', 1)
-    except:
-        subject_and_body = template.render(context).split('\n', 1)
+        for message, email in messages:
+            message.connection = connection
+            try:
+                if connection.send_messages([message]):
+                    sent.append(message)
+                    LOGGER.info("email sent: to='%s' template='%s' context=%s" % (
+                        message.to, email['email_template'], email['context']
+                    ))
+                else:
+                    failed.append((message, None))
+            except Exception as e:
+                LOGGER.error("email failed: to='%s' template='%s' error=%s" % (
+                    message.to, email['email_template'], e
+                ))
+                failed.append((message, e))
+                # the connection may have been dropped
+                connection.close()
+                try:
+                    connection.open()
+                except Exception as e:
+                    # each remaining message will try to reconnect (and fail) on its own
+                    LOGGER.error("couldn't reconnect to the mail server: %s" % e)
+    finally:
+        connection.close()
+
+    return sent, failed
+
+
+def build_message(recipients, email_template, context, attachments=None, reply_to=None, bcc=False, **kwargs):
+    """
+    Renders an email (see send() for the parameters).
+
+    :return: the (unsent) EmailMessage
+    """
+    text_template, html_template = get_email_templates(email_template)
+    subject_and_body = render_template(text_template, context).split('\n', 1)
     if isinstance(recipients, str) or isinstance(recipients, User):
         recipients = [recipients]
 
-    to = [recipient if isinstance(recipient, str) else get_users_email_address_from_lookup(recipient)
-          for recipient in recipients]
+    # the users' addresses are looked up together
+    users = [recipient for recipient in recipients if not isinstance(recipient, str)]
+    addresses = iter(get_users_email_addresses_from_lookup(users))
+    to = [recipient if isinstance(recipient, str) else next(addresses) for recipient in recipients]
 
     if reply_to:
         if reply_to.__class__ == list:
@@ -187,14 +867,8 @@ def send(recipients, email_template, context, attachments=None, reply_to=None, b
 
     message = EmailMultiAlternatives(**final_kwargs)
 
-    try:
-        template = get_template('email/' + email_template + '.html')
-        try:
-            message.attach_alternative(template.render(Context(context)), "text/html")
-        except:
-            message.attach_alternative(template.render(context), "text/html")
-    except TemplateDoesNotExist:
-        pass
+    if html_template is not None:
+        message.attach_alternative(render_template(html_template, context), "text/html")
 
     if attachments:
         if attachments.__class__ != list:
@@ -202,15 +876,137 @@ def send(recipients, email_template, context, attachments=None, reply_to=None, b
         for attachment in attachments:
             if attachment.__class__ == tuple:
                 message.attachments.append(attachment)
+            elif isinstance(attachment, LinkedAttachment):
+                # a file that was too big to attach when the email was queued (see make_envelope())
+                _add_download_link(message, attachment.name, _attachment_url(attachment.url))
             else:
-                message.attach(attachment.name, attachment.read())
-
-    message.send()
-    LOGGER.info("email sent: to='%s' template='%s' context=%s" % (to, email_template, context))
+                attach_file(message, attachment)
 
     return message
 
 
+# The number of bytes of an attachment read at a time (a multiple of 57 so that each chunk encodes to whole 76
+# character base64 lines)
+ATTACHMENT_CHUNK_SIZE = 57 * 1024
+
+
+def attach_file(message, attachment):
+    """
+    Attaches a file to a message. The file is base64 encoded a chunk at a time but it isn't streamed: the encoded
+    payload (about 4/3 of the file's size) is held in memory until the message is sent, so set
+    EMAIL_ATTACHMENT_MAX_SIZE to avoid attaching large files. If the file is bigger than EMAIL_ATTACHMENT_MAX_SIZE
+    bytes (if set) and has a url then a link to download it is added to the message instead. Relative urls are joined
+    to EMAIL_ATTACHMENT_BASE_URL.
+
+    :param message: the EmailMultiAlternatives
+    :param attachment: a file (e.g. a django File or FieldFile)
+    """
+    max_size = getattr(settings, 'EMAIL_ATTACHMENT_MAX_SIZE', None)
+    if max_size is not None:
+        size = _get_file_size(attachment)
+        url = getattr(attachment, 'url', None)
+        if size is not None and size > max_size:
+            if url:
+                _add_download_link(message, attachment.name, _attachment_url(url))
+                return
+            LOGGER.warning("attachment '%s' is %d bytes but has no url to link to - attaching it anyway" % (
+                attachment.name, size
+            ))
+
+    mimetype = mimetypes.guess_type(attachment.name)[0] or 'application/octet-stream'
+    part = MIMEBase(*mimetype.split('/', 1))
+    encoded = bytearray()
+    while True:
+        chunk = attachment.read(ATTACHMENT_CHUNK_SIZE)
+        if not chunk:
+            break
+        if not isinstance(chunk, bytes):
+            chunk = chunk.encode('utf-8')
+        # b2a_base64() encodes a line of up to 57 bytes
+        for i in range(0, len(chunk), 57):
+            encoded += binascii.b2a_base64(chunk[i:i + 57])
+    payload = encoded.decode('ascii')
+    del encoded
+    part.set_payload(payload)
+    part['Content-Transfer-Encoding'] = 'base64'
+    part.add_header('Content-Disposition', 'attachment', filename=attachment.name)
+    message.attach(part)
+
+
+def _attachment_url(url):
+    """
+    :return: the url joined to EMAIL_ATTACHMENT_BASE_URL (if it is relative)
+    """
+    return urljoin(getattr(settings, 'EMAIL_ATTACHMENT_BASE_URL', ''), url)
+
+
+def _get_file_size(attachment):
+    """
+    :return: the size of a file in bytes or None if it can't be found without reading it
+    """
+    size = getattr(attachment, 'size', None)
+    if size is not None:
+        return size
+    try:
+        return os.fstat(attachment.fileno()).st_size
+    except Exception:
+        return None
+
+
+def _add_download_link(message, name, url):
+    """
+    Adds a link to download a file (that is too big to attach) to the end of a message (and its html alternative).
+    """
+    message.body += "\n\n%s is too large to attach - download it from %s\n" % (name, url)
+    for i, (content, mimetype) in enumerate(message.alternatives):
+        if mimetype == "text/html":
+            link = '<p>%s is too large to attach - <a href="%s">download it</a></p>' % (escape(name), escape(url))
+            if '</body>' in content:
+                content = content.replace('</body>', link + '</body>', 1)
+            else:
+                content += link
+            message.alternatives[i] = (content, mimetype)
+
+
+# The (text, html) templates of each email template name (see get_email_templates())
+_email_templates = {}
+
+
+def get_email_templates(email_template):
+    """
+    Gets the text template of an email and its html template (if it has one). Unless DEBUG is set, the templates
+    (and the lack of an html template) are cached for the life of the process.
+
+    :param email_template: the email template name
+    :return: a (text template, html template or None) tuple
+    """
+    templates = _email_templates.get(email_template)
+    if templates is None:
+        text_template = get_template('email/' + email_template + '.txt')
+        try:
+            html_template = get_template('email/' + email_template + '.html')
+        except TemplateDoesNotExist:
+            html_template = None
+        templates = (text_template, html_template)
+        if not settings.DEBUG:
+            _email_templates[email_template] = templates
+    return templates
+
+
+def render_template(template, context):
+    """
+    Renders a template with a context dict - wrapping it in a Context if the template is a legacy
+    django.template.Template (rather than a template from a template engine).
+
+    :param template: the template
+    :param context: the context dict
+    :return: the rendered template
+    """
+    if isinstance(template, Template):
+        return template.render(Context(context))
+    return template.render(context)
+
+
 def merge_dicts(dict1, dict2):
     """
     Merge 2 dictionaries.
@@ -220,23 +1016,68 @@ def merge_dicts(dict1, dict2):
     return merged
 
 
-def json_date_parser(json_dict):
+def make_json_date_parser(key_pattern="DATE"):
     """
-    Used to convert dates when de-serialising JSON. Looks for keys containing the string "DATE" and tries to convert
-    their value to a datetime.
+    Builds a JSON object hook that converts dates when de-serialising JSON. The values of keys matching key_pattern
+    are converted to datetimes if they are ISO 8601 date/times (with optional fractional seconds and timezone offset).
+    Whether a key matches is remembered (for up to 1000 keys) as the same keys are usually repeated in many objects.
 
-    Usage: json.loads(x, object_hook=json_date_parser)
+    Usage: json.loads(x, object_hook=make_json_date_parser("DATE|TIME"))
 
-    :param json_dict: dict loaded from JSON.
-    :return: json_dict
+    :param key_pattern: a regular expression (string or compiled) that is searched for in each key
+    :return: the object hook
     """
-    for k, v in json_dict.items():
-        if isinstance(v, str) and re.search("DATE", k):
-            try:
-                json_dict[k] = datetime.datetime.strptime(v, "%Y-%m-%dT%H:%M:%S")
-            except ValueError:
-                pass
-    return json_dict
+    match_key = re.compile(key_pattern).search if isinstance(key_pattern, six.string_types) else key_pattern.search
+    matches = {}
+
+    def parser(json_dict):
+        for k, v in json_dict.items():
+            if not isinstance(v, six.string_types):
+                continue
+            matched = matches.get(k)
+            if matched is None:
+                matched = bool(match_key(k))
+                if len(matches) < 1000:
+                    matches[k] = matched
+            if matched:
+                parsed = parse_iso_datetime(v)
+                if parsed is not None:
+                    json_dict[k] = parsed
+        return json_dict
+
+    return parser
+
+
+# datetime.fromisoformat() is only available from python 3.7
+_fromisoformat = getattr(datetime.datetime, 'fromisoformat', None)
+
+
+def parse_iso_datetime(value):
+    """
+    Parses an ISO 8601 date/time (a date alone isn't parsed) with datetime.fromisoformat() (if available) or
+    django's parse_datetime(). A 'Z' suffix is treated as UTC.
+
+    :param value: the string to parse
+    :return: the datetime (aware if value has an offset) or None if value isn't an ISO 8601 date/time
+    """
+    if len(value) < 16 or value[10] not in 'T ':
+        return None
+    if _fromisoformat is not None:
+        try:
+            return _fromisoformat(value[:-1] + '+00:00' if value.endswith('Z') else value)
+        except ValueError:
+            pass
+    try:
+        return parse_datetime(value)
+    except ValueError:
+        return None
+
+
+# Used to convert dates when de-serialising JSON. Looks for keys containing the string "DATE" and tries to convert
+# their value to a datetime.
+#
+# Usage: json.loads(x, object_hook=json_date_parser)
+json_date_parser = make_json_date_parser()
 
 
 def json_date_formatter(obj):
@@ -252,3 +1093,77 @@ def json_date_formatter(obj):
         return obj.isoformat()
     else:
         raise TypeError
+
+
+def iter_json_array(objects, chunk_size=100):
+    """
+    Encodes objects as a JSON array a chunk (of chunk_size objects) at a time so that the whole document is never in
+    memory. Dates are formatted with json_date_formatter.
+
+    Usage: StreamingHttpResponse(iter_json_array(queryset.values().iterator()), content_type='application/json')
+
+    :param objects: an iterable of JSON serialisable objects
+    :param chunk_size: the number of objects encoded per chunk
+    :return: a generator of JSON strings
+    """
+    encode = json.JSONEncoder(default=json_date_formatter).encode
+    separator = '['
+    chunk = []
+    for obj in objects:
+        chunk.append(separator + encode(obj))
+        separator = ','
+        if len(chunk) == chunk_size:
+            yield ''.join(chunk)
+            chunk = []
+    chunk.append('[]' if separator == '[' else ']')
+    yield ''.join(chunk)
+
+
+def iter_json_lines(objects, chunk_size=100):
+    """
+    Encodes objects as JSON Lines (one JSON document per line) a chunk (of chunk_size objects) at a time. Dates are
+    formatted with json_date_formatter.
+
+    :param objects: an iterable of JSON serialisable objects
+    :param chunk_size: the number of objects encoded per chunk
+    :return: a generator of strings of JSON lines
+    """
+    encode = json.JSONEncoder(default=json_date_formatter).encode
+    chunk = []
+    for obj in objects:
+        chunk.append(encode(obj) + '\n')
+        if len(chunk) == chunk_size:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
+
+
+def read_json_lines(lines, object_hook=json_date_parser):
+    """
+    Decodes JSON Lines one line at a time (e.g. from an open file) converting dates with object_hook.
+
+    Usage: for record in read_json_lines(gzip.open(path)): ...
+
+    :param lines: an iterable of lines (strings or utf-8 bytes)
+    :param object_hook: the JSON object hook (default json_date_parser)
+    :return: a generator of the decoded objects
+    """
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        line = line.strip()
+        if line:
+            yield json.loads(line, object_hook=object_hook)
+
+
+def streaming_json_response(objects, lines=False, chunk_size=100):
+    """
+    :param objects: an iterable of JSON serialisable objects (e.g. queryset.values().iterator())
+    :param lines: if True then the response is JSON Lines rather than a JSON array
+    :param chunk_size: the number of objects encoded per chunk
+    :return: a StreamingHttpResponse of the objects encoded as JSON
+    """
+    if lines:
+        return StreamingHttpResponse(iter_json_lines(objects, chunk_size), content_type='application/x-ndjson')
+    return StreamingHttpResponse(iter_json_array(objects, chunk_size), content_type='application/json')
@@ -1,11 +1,10 @@
 import logging
 import os
-import requests
-from django.conf import settings
 from django.contrib.auth.decorators import user_passes_test
-from django.contrib.auth.models import User
+from django.http import HttpResponse, JsonResponse
 from django.shortcuts import render
-from zeep import Client
+
+from automationcommon import health
 
 LOGGER = logging.getLogger('automationcommon')
 
@@ -22,34 +21,17 @@ def status(request):
     """
     Checks that all the services (external or internal) used by the Self-Service Gateway are working,
     returning a HTTP 500 if any of them do not work, or a 200 otherwise. It contains individual services checklist
-    in the view.
+    in the view. The results (and metrics) are returned as JSON if the request accepts application/json or has
+    format=json and in the Prometheus text format if it has format=prometheus (see status_metrics()).
     """
 
-    status_results = {}
-    try:
-        User.objects.first()
-        status_results['Database'] = True
-    except:
-        status_results['Database'] = False
-
-    overall_result = status_results['Database']
-
-    if hasattr(settings, 'SERVICE_CHECKS'):
-        for name, service in settings.SERVICE_CHECKS.items():
-            try:
-                if isinstance(service, str):
-                    # treat as REST endpoint
-                    response = requests.get(service)
-                    status_results[name] = response.status_code == 200
-                else:
-                    # assume soap descriptor
-                    client = Client(service['url'])
-                    proxy = client.bind(service_name=service['name'], port_name=service['name'] + 'Soap12')
-                    proxy[service['operation']]()
-                    status_results[name] = True
-            except Exception as e:
-                status_results[name] = False
-            overall_result = overall_result and status_results[name]
+    # the services are checked concurrently with timeouts (see health.run_checks()) or, if SERVICE_CHECK_INTERVAL
+    # is set, the latest results checked in the background are used (see health.get_status())
+    results, status_age = health.get_status()
+    status_results = dict((name, result) for name, (result, latency) in results.items())
+    status_latencies = dict((name, int(latency * 1000)) for name, (result, latency) in results.items())
+
+    overall_result = all(status_results.values())
 
     if not overall_result:
         LOGGER.error("Status Webpage returning 500: %s" % status_results)
@@ -58,5 +40,32 @@ def status(request):
     # Deployments can use this to indicate which commit is deployed, etc.
     context_info = os.environ.get('AUTOMATION_WEBAPP_CONTEXT', '')
 
-    return render(request, 'status.html', {'context_info': context_info, 'status_results': status_results},
-                  status=200 if overall_result else 500)
+    output_format = request.GET.get('format')
+    if output_format == 'prometheus':
+        return _prometheus_response(results, status_age)
+    if output_format == 'json' or (
+        output_format is None and 'application/json' in request.META.get('HTTP_ACCEPT', '')
+    ):
+        status = health.status_as_dict(results, status_age)
+        status['context_info'] = context_info
+        return JsonResponse(status, status=200 if overall_result else 500)
+
+    return render(request, 'status.html', {
+        'context_info': context_info, 'status_results': status_results, 'status_latencies': status_latencies,
+        'from_snapshot': status_age is not None, 'status_age': status_age,
+    }, status=200 if overall_result else 500)
+
+
+def status_metrics(request):
+    """
+    Returns the status of all the services and the check latency histograms and error counts in the Prometheus text
+    format. Unlike status(), a HTTP 200 is always returned so that a failing service doesn't look like a failed scrape.
+    """
+    results, status_age = health.get_status()
+    return _prometheus_response(results, status_age)
+
+
+def _prometheus_response(results, status_age):
+    return HttpResponse(
+        health.status_as_prometheus(results, status_age), content_type='text/plain; version=0.0.4; charset=utf-8'
+    )
@@ -14,7 +14,8 @@ settings.configure(DEBUG=True,
                               'django.contrib.admin',
                               'ucamlookup',
                               'ucamwebauth',
-                              'automationcommon',))
+                              'automationcommon',
+                              'automationcommon.tests',))
 
 # Django >= 1.8
 django.setup()